@@ -1,12 +1,19 @@
 #!/usr/bin/env python2.7
 
 import dicom
-from dicom.errors import InvalidDicomError
 
 import numpy as np
 from PIL import Image, ImageDraw
 
-import os,csv
+import os,csv,tempfile,time,argparse,json,shutil
+import cPickle as pickle
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import zlib,bz2
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 
 
@@ -36,13 +43,16 @@ class ImageTools():
         """Parse the given DICOM filename
 
         :param filename: filepath to the DICOM file to parse
-        :return: dictionary with DICOM image data
+        :return: dictionary with DICOM image data, None if unreadable
         """
         try:
             dcm = dicom.read_file(filename)
         except IOError as err:
             print 'Error:', os.strerror(err.errno),', file: ', filename
             return None
+        except Exception as err: # truncated or corrupt files raise various decode errors
+            print 'Error:', err, ', file: ', filename
+            return None
         
         try:
             dcm_image = dcm.pixel_array
@@ -69,8 +79,60 @@ class ImageTools():
                         'width'      : dcm_width
                        }
             return dcm_dict
-        except InvalidDicomError:
+        except Exception as err:
+            print 'Error:', err, ', file: ', filename
+            return None
+    
+
+    def read_dicom_raw(self,filename):
+        """Read the stored pixel values of the given DICOM filename without rescaling
+
+        :param filename: filepath to the DICOM file to parse
+        :return: (pixel_array,slope,intercept) such that pixel_array*slope+intercept
+                 equals the pixel data of parse_dicom_file, None if unreadable
+        """
+        try:
+            dcm = dicom.read_file(filename)
+            dcm_image = dcm.pixel_array
+        except Exception as err: # truncated or corrupt files raise various decode errors
+            print 'Error:', err, ', file: ', filename
+            return None
+
+        intercept = float(getattr(dcm,'RescaleIntercept',0.0))
+        slope     = float(getattr(dcm,'RescaleSlope',0.0))
+        if intercept != 0.0 and slope != 0.0:
+            return dcm_image, slope, intercept
+        return dcm_image, 1.0, 0.0
+
+
+    def parse_dicom_header(self,filename):
+        """Parse the header of the given DICOM filename without decoding pixel data
+
+        :param filename: filepath to the DICOM file to parse
+        :return: dictionary with image dimensions and position tags, None if unreadable
+        """
+        try:
+            dcm = dicom.read_file(filename,stop_before_pixels=True)
+            height, width = int(dcm.Rows), int(dcm.Columns)
+        except Exception as err: # truncated or corrupt files raise various decode errors
+            print 'Error:', err, ', file: ', filename
             return None
+
+        def getFloat(tag):
+            try:
+                return float(getattr(dcm,tag))
+            except (AttributeError,TypeError,ValueError):
+                return None
+
+        position = getattr(dcm,'ImagePositionPatient',None)
+        dcm_dict = {'height'          : height,
+                    'width'           : width,
+                    'slice_location'  : getFloat('SliceLocation'),
+                    'trigger_time'    : getFloat('TriggerTime'),
+                    'instance_number' : getFloat('InstanceNumber'),
+                    'position'        : None if position==None else [float(v) for v in position]
+                   }
+        return dcm_dict
     
 
     def poly_to_mask(self,polygon, width, height):
@@ -90,6 +152,40 @@ class ImageTools():
         return mask
     
     
+    def poly_to_labels(self,polygons,labels,width,height):
+        """Rasterize several polygons into one label map
+
+        :param polygons: list of polygons, each a list of pairs of x, y coords
+        :param labels: label value of each polygon, later polygons overwrite earlier ones
+        :param width: scalar image width
+        :param height: scalar image height
+        :return: uint8 label map of shape (height, width)
+        """
+
+        # combine the masks of poly_to_mask, so that each label equals its mask exactly
+        labelMap = np.zeros((height,width),dtype=np.uint8)
+        for polygon, label in zip(polygons,labels):
+            labelMap[self.poly_to_mask(polygon,width,height)] = label
+        return labelMap
+    
+    
+    def getContourLabels(self,i_contourFile,o_contourFile,width,height):
+        """ Create label map background (0), blood pool (1), myocardium (2) from contour files
+        :param i_contourFile: filepath to the i-contour file
+        :param o_contourFile: filepath to the o-contour file, None for blood pool only
+        :param width: scalar image width
+        :param height: scalar image height       
+        :return: uint8 label map of shape (height, width)
+        """
+        
+        polygons = [self.parse_contour_file(i_contourFile)]
+        labels   = [1]
+        if o_contourFile!=None:
+            polygons.insert(0,self.parse_contour_file(o_contourFile))
+            labels.insert(0,2)
+        return self.poly_to_labels(polygons,labels,width,height)
+    
+    
     def getContourMask(self,contourFile,width,height):
         """ Create mask from contour file (convenience method)
         :param filename: filepath to the contourfile to parse
@@ -167,7 +263,434 @@ class DicomReader(ImageTools):
             return self.parse_dicom_file(dcmFile) 
         
 
-class DicomContourReaderBase():
+class DicomVolumeIndex(DicomReader):
+    """ Orders the dicom images of a patient directory by slice location and cardiac phase.
+        Only the dicom headers are read, images with unreadable headers are left out.
+    """
+    def __init__(self,dcmPath):
+        DicomReader.__init__(self,dcmPath)
+        self.sliceIndex = {} # dictionary from file id to (slice number, phase number)
+        self.volumeMap  = {} # dictionary from (slice number, phase number) to file id
+        self.nphases    = [] # number of phases of each slice
+        self.headers    = {} # dictionary from file id to dicom header
+        self.unreadable = [] # file ids of images with unreadable headers
+        
+        self.createVolumeIndex()
+        
+    def createVolumeIndex(self):
+        """ Read all headers and sort the files into slices and phases """
+        
+        if self._nima<1:
+            return
+        
+        locations = {}
+        for fileId in self.dcmFileIds:
+            header = self.parse_dicom_header(self.getDicomImageFile(fileId))
+            if header==None:
+                self.unreadable.append(fileId)
+                continue
+            self.headers[fileId] = header
+            
+            # slice location, fall back to the position along the patient axis
+            location = header['slice_location']
+            if location==None and header['position']!=None:
+                location = header['position'][2]
+            location = round(location,2) if location!=None else 0.0
+            
+            # phase order by trigger time, fall back to instance number
+            order = header['trigger_time']
+            if order==None:
+                order = header['instance_number'] if header['instance_number']!=None else 0.0
+            locations.setdefault(location,[]).append((order,fileId))
+        
+        self.nphases = []
+        for sliceNum, location in enumerate(sorted(locations.keys())):
+            phases = sorted(locations[location])
+            self.nphases.append(len(phases))
+            for phaseNum, (_, fileId) in enumerate(phases):
+                self.sliceIndex[fileId] = (sliceNum,phaseNum)
+                self.volumeMap[(sliceNum,phaseNum)] = fileId
+        
+        print "Volume index: {} slices, {} phases".format(len(self.nphases),max(self.nphases or [0]))
+        if len(self.unreadable)>0:
+            print "Warning: {} images with unreadable headers are not in the volume index: {}".format(
+                len(self.unreadable),', '.join(self.unreadable))
+        
+    def getNeighborIds(self,fileId,k=1,axis='temporal'):
+        """ File ids of the 2k+1 images centered at fileId
+        :param fileId: string
+        :param k: number of neighbors on each side
+        :param axis: 'temporal' (same slice, cyclic phases) or 'spatial' (same phase, adjacent slices)
+        :return: list of file ids, repeated at the volume borders, None if fileId is not indexed
+        """
+        if not self.sliceIndex.has_key(fileId):
+            print "Unknown dicom file ID {} in volume index".format(fileId)
+            return None
+        
+        sliceNum, phaseNum = self.sliceIndex[fileId]
+        neighbors = []
+        for offset in range(-k,k+1):
+            if axis=='temporal':
+                key = (sliceNum,(phaseNum+offset) % self.nphases[sliceNum])
+            else:
+                s   = min(max(sliceNum+offset,0),len(self.nphases)-1)
+                key = (s,min(phaseNum,self.nphases[s]-1))
+            neighbors.append(self.volumeMap[key])
+        return neighbors
+        
+
+
+class ImageAugmentation():
+    """ Vectorized augmentation of whole image batches (N, H, W).
+        Flips, 90 degree rotations and shifts are computed as one index map per sample
+        and applied identically to the image batch and all mask batches.
+    """
+
+    def setAugmentation(self,flipProb=0.5,rot90=True,maxShift=0,scaleRange=None,seed=None):
+        """ Enable batch augmentation
+        :param flipProb: probability of a left-right and of an up-down flip
+        :param rot90: apply random rotations by multiples of 90 degrees
+        :param maxShift: maximal shift in pixels along each axis
+        :param scaleRange: (min,max) of the intensity scaling factor, None to disable
+        :param seed: seed of the augmentation random state
+        """
+        self.augment      = True
+        self.augFlipProb  = flipProb
+        self.augRot90     = rot90
+        self.augMaxShift  = int(maxShift)
+        self.augScale     = scaleRange
+        self.augRandom    = np.random.RandomState(seed)
+
+
+    def drawAugmentParams(self,nsamples,square=True):
+        """ Draw transform parameters for each sample of a batch
+        :param nsamples: number of samples in the batch
+        :param square: odd rotations are only drawn for square images
+        :return: dictionary with one parameter array of length nsamples per transform
+        """
+        rnd = self.augRandom
+
+        params = {'flip_lr' : rnd.rand(nsamples) < self.augFlipProb,
+                  'flip_ud' : rnd.rand(nsamples) < self.augFlipProb,
+                  'rot90'   : np.zeros(nsamples,dtype=int),
+                  'shift_y' : np.zeros(nsamples,dtype=int),
+                  'shift_x' : np.zeros(nsamples,dtype=int),
+                  'scale'   : np.ones(nsamples)
+                 }
+
+        if self.augRot90:
+            if square:
+                params['rot90'] = rnd.randint(0,4,nsamples)
+            else:
+                params['rot90'] = 2*rnd.randint(0,2,nsamples)
+        if self.augMaxShift>0:
+            params['shift_y'] = rnd.randint(-self.augMaxShift,self.augMaxShift+1,nsamples)
+            params['shift_x'] = rnd.randint(-self.augMaxShift,self.augMaxShift+1,nsamples)
+        if self.augScale!=None:
+            params['scale'] = rnd.uniform(self.augScale[0],self.augScale[1],nsamples)
+
+        return params
+
+
+    def getAugmentIndices(self,params,height,width):
+        """ Source pixel coordinates of every output pixel (inverse transform)
+        :param params: transform parameters from drawAugmentParams
+        :param height: scalar image height
+        :param width: scalar image width
+        :return: (srcY,srcX,valid) arrays of shape (N, height, width)
+        """
+        nsamples = len(params['rot90'])
+        yy, xx = np.mgrid[0:height,0:width]
+
+        # undo shift
+        y = yy[None,:,:] - params['shift_y'][:,None,None]
+        x = xx[None,:,:] - params['shift_x'][:,None,None]
+
+        # undo rotation, np.rot90 convention: out[i,j] = in[j,n-1-i]
+        k = params['rot90'][:,None,None] % 4
+        srcY = np.where(k==0, y, np.where(k==1, x, np.where(k==2, height-1-y, width-1-x)))
+        srcX = np.where(k==0, x, np.where(k==1, width-1-y, np.where(k==2, width-1-x, y)))
+
+        # undo flips
+        srcX = np.where(params['flip_lr'][:,None,None], width-1-srcX, srcX)
+        srcY = np.where(params['flip_ud'][:,None,None], height-1-srcY, srcY)
+
+        valid = (srcY>=0) & (srcY<height) & (srcX>=0) & (srcX<width)
+        srcY  = np.clip(srcY,0,height-1)
+        srcX  = np.clip(srcX,0,width-1)
+
+        return srcY, srcX, valid
+
+
+    def augmentBatch(self,imaBatch,*maskBatches):
+        """ Apply random transforms to an image batch and its mask batches
+        :param imaBatch: image batch of shape (N, H, W) or (N, C, H, W)
+        :param maskBatches: mask or target batches of shape (N, H, W), or dictionaries of them.
+                            Pixels shifted in from outside are 0, except for distance maps
+                            (dictionary keys ending in '_sdt') which replicate the image edge.
+        :return: tuple (imaBatch, mask batches...) of transformed batches
+        """
+        nsamples, height, width = imaBatch.shape[0], imaBatch.shape[-2], imaBatch.shape[-1]
+        params = self.drawAugmentParams(nsamples, height==width)
+        srcY, srcX, valid = self.getAugmentIndices(params,height,width)
+        nidx = np.arange(nsamples)[:,None,None]
+
+        def transform(batch,replicate=False):
+            # source indices are clipped, so skipping the fill replicates the edge
+            if batch.ndim==4:
+                cidx = np.arange(batch.shape[1])[None,:,None,None]
+                out  = batch[nidx[:,None],cidx,srcY[:,None],srcX[:,None]]
+                if not replicate:
+                    out[~np.broadcast_to(valid[:,None],out.shape)] = 0
+            else:
+                out = batch[nidx,srcY,srcX]
+                if not replicate:
+                    out[~valid] = 0
+            return out
+
+        ima = transform(imaBatch)
+        ima *= params['scale'].reshape((nsamples,)+(1,)*(ima.ndim-1))
+
+        out = [ima]
+        for maskBatch in maskBatches:
+            if isinstance(maskBatch,dict):
+                out.append(dict((key,transform(batch,key.endswith('_sdt'))) for key,batch in maskBatch.items()))
+            else:
+                out.append(transform(maskBatch))
+
+        return tuple(out)
+
+
+
+class ContourTargets():
+    """ Signed distance maps, truncated at maxDistance, and boundary bands computed from contour polygons.
+        Distance maps are read from the sample cache if it holds them, else computed once per
+        sample and kept in a store sized to the data set if enabled.
+    """
+
+    def setTargets(self,boundaryWidth=1.0,cache=True,maxDistance=16.0,max_memory=None):
+        """ Enable distance map and boundary targets for all batches
+        :param boundaryWidth: half width of the boundary band in pixels
+        :param cache: keep the distance maps of all samples, computed at first use
+        :param maxDistance: distances are truncated at maxDistance pixels, None for exact maps
+        :param max_memory: memory budget in bytes of the store, memory-mapped above
+        """
+        self.targets       = True
+        self.boundaryWidth = boundaryWidth
+        self.maxDistance   = maxDistance
+        self.cacheTargets  = cache
+        self.targetMemory  = max_memory
+        self.resetTargetStore()
+
+
+    def resetTargetStore(self):
+        """ Drop the stored distance maps, needed whenever the data indices change """
+        
+        self.targetStore = None  # (ndata, ncontours, H, W) float32 distance maps
+        self.targetValid = None  # (ndata,) True where the maps of a sample are stored
+
+
+    def polygonDistance(self,polygon,width,height,maxDistance=None,chunk=8):
+        """ Distance of every pixel to the closest polygon edge, truncated at maxDistance.
+            Consecutive edges are processed in chunks, each only on the pixels of its
+            bounding box extended by maxDistance, so the work grows with the contour length.
+        :param polygon: list of pairs of x, y coords [(x1, y1), (x2, y2), ...]
+        :param width: scalar image width
+        :param height: scalar image height
+        :param maxDistance: truncation distance in pixels, None for exact distances everywhere
+        :param chunk: number of edges processed at once
+        :return: float array of shape (height, width)
+        """
+        if maxDistance==None:
+            maxDistance = np.hypot(height,width)
+        start = np.asarray(polygon,dtype=np.float32)
+        edge  = np.roll(start,-1,axis=0) - start
+        elen2 = np.maximum((edge**2).sum(axis=1),1e-6)
+
+        dist2 = np.empty((height,width),dtype=np.float32)
+        dist2.fill(maxDistance**2)
+
+        for s in range(0,len(start),chunk):
+            a, e = start[s:s+chunk], edge[s:s+chunk]
+            ends = np.concatenate((a,a+e))
+            x0, y0 = np.maximum(np.floor(ends.min(axis=0)-maxDistance).astype(int),0)
+            x1, y1 = np.minimum(np.ceil(ends.max(axis=0)+maxDistance).astype(int)+1,(width,height))
+            if x0>=x1 or y0>=y1:
+                continue
+
+            px = np.arange(x0,x1,dtype=np.float32)[None,None,:]
+            py = np.arange(y0,y1,dtype=np.float32)[None,:,None]
+            ex, ey = e[:,0,None,None], e[:,1,None,None]
+            rx, ry = px-a[:,0,None,None], py-a[:,1,None,None]
+            t  = np.clip((rx*ex + ry*ey)/elen2[s:s+chunk,None,None],0,1)
+            rx = rx - t*ex
+            ry = ry - t*ey
+            window = dist2[y0:y1,x0:x1]
+            np.minimum(window,(rx*rx + ry*ry).min(axis=0),out=window)
+
+        return np.sqrt(dist2)
+
+
+    def signedDistance(self,polygon,width,height,maxDistance=None,mask=None):
+        """ Signed distance map of a polygon, negative inside
+        :param mask: rasterized polygon if already available
+        :return: float32 array of shape (height, width)
+        """
+        if mask is None:
+            mask = self.poly_to_mask(polygon,width,height)
+        dist = self.polygonDistance(polygon,width,height,maxDistance)
+        return np.where(mask,-dist,dist).astype(np.float32)
+
+
+    def getContourTargets(self,contourFile,width,height):
+        """ Signed distance map (negative inside) and boundary band of a contour file
+        :param contourFile: filepath to the contourfile to parse
+        :param width: scalar image width
+        :param height: scalar image height
+        :return: (sdt,boundary) float32 and Boolean arrays of shape (height, width)
+        """
+        polyCoords = self.parse_contour_file(contourFile)
+        sdt        = self.signedDistance(polyCoords,width,height,self.maxDistance)
+        return sdt, np.abs(sdt)<=self.boundaryWidth
+
+
+    def getSampleDistances(self,dataIdx,cache=True):
+        """ Distance maps of all contours of the samples dataIdx at full resolution
+        :param cache: use and fill the target store if enabled in setTargets
+        :return: float32 array of shape (len(dataIdx), ncontours, H, W), NaN for missing contours
+        """
+        ncontours = len(self.allFilePairs[0])-1
+        cache     = cache and self.cacheTargets
+        if cache and self.targetStore is None:
+            alloc, _ = self.getDataAllocator(self._ndata*ncontours*self.imaHeight*self.imaWidth*4,
+                                             self.targetMemory)
+            self.targetStore = alloc((self._ndata,ncontours,self.imaHeight,self.imaWidth),np.float32)
+            self.targetValid = np.zeros(self._ndata,dtype=bool)
+
+        dists = np.empty((len(dataIdx),ncontours,self.imaHeight,self.imaWidth),dtype=np.float32)
+        for k, idx in enumerate(dataIdx):
+            if cache and self.targetValid[idx]:
+                dists[k] = self.targetStore[idx]
+                continue
+            for c, contFile in enumerate(self.allFilePairs[idx][1:]):
+                if contFile==None:
+                    dists[k,c] = np.nan
+                else:
+                    dists[k,c] = self.getContourTargets(contFile,self.imaWidth,self.imaHeight)[0]
+            if cache:
+                self.targetStore[idx] = dists[k]
+                self.targetValid[idx] = True
+        return dists
+
+
+    def getTargetBatches(self,dataIdx,batchSize,alloc=np.zeros,cache=True,level=0):
+        """ Distance map and boundary batches for all contours of the batch samples
+        :param dataIdx: data indices of the batch samples
+        :param batchSize: first dimension of the target batches
+        :param alloc: function (shape,dtype) returning a zero initialized array
+        :param cache: use the target store, disable for single passes over the data set
+        :param level: pyramid level, only available if the sample cache holds the distance maps
+        :return: dictionary with '<c>_sdt' and '<c>_boundary' batches for c in 'i','o'.
+                 The distance map of a missing contour is NaN and its boundary is empty,
+                 mask the 'o' targets with o_valid before computing losses.
+        """
+        batchDim  = (batchSize, self.imaHeight>>level, self.imaWidth>>level)
+        names     = ['i','o'][:len(self.allFilePairs[0])-1]
+        sdtBatches = [alloc(batchDim,np.float32) for name in names]
+
+        if self.hasCachedTargets():
+            self.loadCachedSamples(dataIdx,None,[],level=level,targetBatches=sdtBatches)
+        else:
+            for start in range(0,len(dataIdx),self.batchSize):
+                dists = self.getSampleDistances(dataIdx[start:start+self.batchSize],cache)
+                for c, sdtBatch in enumerate(sdtBatches):
+                    sdtBatch[start:start+len(dists)] = dists[:,c]
+
+        targets = {}
+        for name, sdtBatch in zip(names,sdtBatches):
+            boundary = alloc(batchDim,bool)
+            with np.errstate(invalid='ignore'):
+                for k in range(len(dataIdx)):
+                    boundary[k] = np.abs(sdtBatch[k])<=self.boundaryWidth
+            targets[name+'_sdt']      = sdtBatch
+            targets[name+'_boundary'] = boundary
+
+        return targets
+
+
+
+class ContourGeometry():
+    """ Contour geometry computed from the polygon coordinates without rasterization.
+        All polygons are processed at once, lengths are in pixels and areas in square pixels.
+    """
+    geometryKeys = ['area','perimeter','centroid_x','centroid_y','xmin','xmax','ymin','ymax']
+
+    def polygonGeometry(self,polygons):
+        """ Shoelace area, perimeter, centroid and bounding box of a list of polygons
+        :param polygons: list of vertex lists [(x1, y1), (x2, y2), ...], None for a missing polygon
+        :return: dictionary of arrays with one entry per polygon, NaN for missing polygons
+        """
+        npoly    = len(polygons)
+        lengths  = np.array([0 if poly is None else len(poly) for poly in polygons],dtype=int)
+        valid    = lengths>0
+        geometry = dict((key,np.full(npoly,np.nan)) for key in self.geometryKeys)
+        if not valid.any():
+            return geometry
+
+        # all vertices in one array, nxt is the following vertex of the closed polygon
+        xy = np.concatenate([np.asarray(polygons[k],dtype=float).reshape(-1,2) for k in np.flatnonzero(valid)])
+        x, y    = xy[:,0], xy[:,1]
+        nvert   = lengths[valid]
+        starts  = np.concatenate(([0],np.cumsum(nvert)[:-1]))
+        pid     = np.repeat(np.arange(len(nvert)),nvert)
+        nxt     = np.arange(len(x))+1
+        nxt[starts+nvert-1] = starts
+
+        cross  = x*y[nxt] - x[nxt]*y
+        signed = 0.5*np.bincount(pid,cross)
+        edges  = np.hypot(x[nxt]-x,y[nxt]-y)
+
+        # centroid of the area, vertex mean for degenerate polygons
+        degenerate = np.abs(signed)<1e-12
+        denom = np.where(degenerate,1.0,6.0*signed)
+        cx = np.where(degenerate,np.bincount(pid,x)/nvert,np.bincount(pid,(x+x[nxt])*cross)/denom)
+        cy = np.where(degenerate,np.bincount(pid,y)/nvert,np.bincount(pid,(y+y[nxt])*cross)/denom)
+
+        values = {'area'       : np.abs(signed),
+                  'perimeter'  : np.bincount(pid,edges),
+                  'centroid_x' : cx,
+                  'centroid_y' : cy,
+                  'xmin'       : np.minimum.reduceat(x,starts),
+                  'xmax'       : np.maximum.reduceat(x,starts),
+                  'ymin'       : np.minimum.reduceat(y,starts),
+                  'ymax'       : np.maximum.reduceat(y,starts)}
+        for key in self.geometryKeys:
+            geometry[key][valid] = values[key]
+        return geometry
+
+
+    def getGeometryTable(self,contourFiles):
+        """ Columnar geometry table of contour files
+        :param contourFiles: list of tuples (i_contourFile[,o_contourFile]), None or shorter tuples
+                             for missing files
+        :return: dictionary of arrays '<c>_<key>' for c in 'i','o' and the geometry keys,
+                 with 'wall_thickness' (difference of the o-/i-contour equivalent radii) for two contours
+        """
+        table = {}
+        ncontours = max([len(files) for files in contourFiles]+[0])
+        for c, name in enumerate(['i','o'][:ncontours]):
+            polygons = [None if len(files)<=c or files[c] is None else self.parse_contour_file(files[c])
+                        for files in contourFiles]
+            for key, value in self.polygonGeometry(polygons).items():
+                table[name+'_'+key] = value
+
+        if ncontours>1:
+            table['wall_thickness'] = np.sqrt(table['o_area']/np.pi) - np.sqrt(table['i_area']/np.pi)
+        return table
+
+
+
+class DicomContourReaderBase(ContourGeometry):
     """ Super class with general DicomContourReader methods
     """
        
@@ -212,6 +735,46 @@ class DicomContourReaderBase():
             fileList.append(self.getDicomImageAndContourFiles(fileId))
         return fileList      
 
+
+    def getMasks(self,fileId):
+        """ Masks of all contours of a file id without decoding the dicom pixel data.
+            The image size is read from the dicom header.
+        :fileId: string 
+        :return: tuple of masks, empty for a missing o-contour,
+                 None on error or if the dicom header is unreadable (truncated or corrupt file)
+        """
+        files = self.getDicomImageAndContourFiles(fileId)
+        if files[0]==None or files[1]==None:
+            return None
+        
+        header = self.parse_dicom_header(files[0])
+        if header==None:
+            return None
+        
+        width, height = header['width'], header['height']
+        return tuple(np.zeros((height,width),dtype=bool) if contFile==None
+                     else self.getContourMask(contFile,width,height) for contFile in files[1:])
+    
+    
+    def iterMasks(self):
+        """ Iterate over the masks of all contour file ids without decoding pixel data
+        :return: generator of (fileId, masks) as returned by getMasks, unreadable files are skipped
+        """
+        for fileId in sorted(self.contourFileMap.keys()):
+            masks = self.getMasks(fileId)
+            if masks!=None:
+                yield fileId, masks
+    
+
+    def getContourGeometry(self):
+        """ Geometry of all contours, see ContourGeometry.getGeometryTable
+        :return: dictionary of arrays with column 'id' of the contourFileMap IDs
+        """
+        fileIds = sorted(self.contourFileMap.keys())
+        table = self.getGeometryTable([self.getContourFiles(fileId) for fileId in fileIds])
+        table['id'] = np.array(fileIds)
+        return table
+
     
 
 class DicomContourReader(DicomReader,DicomContourReaderBase):
@@ -258,6 +821,13 @@ class DicomContourReader(DicomReader,DicomContourReaderBase):
             contourFile   = os.path.join(self.contourPath,self.contourFileMap[fileId])
             return (dcmFile,contourFile)
 
+
+    def getContourFiles(self,fileId):
+        """ Contour file of a contour file ID, whether or not the dicom file exists
+        :return: (contourFile,)
+        """
+        return (os.path.join(self.contourPath,self.contourFileMap[fileId]),)
+
                 
     def getDicomImageAndMask(self,fileId):
         """ Get a single dicom image and mask from a contour file
@@ -353,6 +923,17 @@ class DicomContourReader2(DicomReader,DicomContourReaderBase):
             return (dcmFile,i_contFile,o_contFile)
       
                 
+    def getContourFiles(self,fileId):
+        """ i-/o-contour files of a contour file ID, whether or not the dicom file exists
+        :return: (i_contourFile,o_contourFile), o_contourFile may be None
+        """
+        i_contFile, o_contFile = self.contourFileMap[fileId]
+        i_contFile = os.path.join(self.i_contourPath,i_contFile)
+        if o_contFile!=None:
+            o_contFile = os.path.join(self.o_contourPath,o_contFile)
+        return (i_contFile,o_contFile)
+      
+                
     def getDicomImageAndMask(self,fileId):
         """ Get a single dicom image and mask from a contour file
         :fileId: string 
@@ -371,79 +952,1659 @@ class DicomContourReader2(DicomReader,DicomContourReaderBase):
         return (dcmData['pixel_data'],i_mask,o_mask)  
 
 
-
-class ImagePipelineBase(ImageTools):
-    """ Image Pipeline Base class with general methods"""
-
-    def read_link_file(self):
-        """ import the link file """
-        
-        try:
-            with open(self.linkFile, "r") as csvfile:
-                reader = csv.reader(csvfile)
-                next(reader, None)  # skip the headers
-                for row in reader:
-                    if len(row)==2: 
-                        self.linkDict[row[0]] = row[1]
-                    else:
-                        print "Warning: unknown format"
-        except IOError as err:
-            print "Error: ", err.args, self.linkFile
-            return
-    
-    
-    def resetBatchOrder(self):
-        """ Reset or initialize batch order and reshuffle"""
-        self.batchStart= 0
-        self.batchEnd  = self.batchStart+self.batchSize
+class DicomContourReader3(DicomReader,DicomContourReaderBase):
+    """ Parses Dicom images with all i-contours and the o-contours where available.
+        A data triple (image,i-contour,o-contour) is returned for every i-contour,
+        the o-contour file is None if the slice has no o-contour.
+    """
+    def __init__(self,dcmPath,contourPath):
+        DicomReader.__init__(self,dcmPath)
+        self.i_contourPath     = os.path.join(contourPath,'i-contours')
+        self.o_contourPath     = os.path.join(contourPath,'o-contours')
+        self.i_contourFileList = []
+        self.o_contourFileList = []
+ 
+        self.i_contourFileMap = {}
+        self.o_contourFileMap = {}
+        self.contourFileMap = {}
+ 
+        self.contourFileIds = []
         
-        if len(self.dataIndex)==0:
-            self.dataIndex = range(self._ndata)
+        self._ncontours = -1 # i_contour exists
         
-        np.random.shuffle(self.dataIndex )
+        self.getContourFileNames()
         
-    
-    def getNextBatchIndices(self):
-        """ Create new set of data indeces for new batch of files"""
+                
+    def getContourFileNames(self):
+        """ Collect all i-/o-contour files names in directory """ 
         
-        if self.batchStart == None:
-            self.resetBatchOrder()
-        else:   
-            # increment
-            self.batchStart += self.batchSize
-            self.batchEnd   += self.batchSize
+        self.i_contourFileList = self.getContourFileList(self.i_contourPath) or []
+        self.o_contourFileList = self.getContourFileList(self.o_contourPath) or []
+                          
+        if len(self.i_contourFileList) < 1:
+            print "No matching contour files were found."       
+        else:
+            self.matchContourIdMap()
+            self.contourFileIds = sorted(self.contourFileMap.keys())
+            self._ncontours = len(self.contourFileIds)
+            print "Found {} contour files".format(self._ncontours) 
             
-            if self.batchEnd>self._ndata:
-                self.resetBatchOrder()
-
+                
+    def matchContourIdMap(self):
+        """Assign each i-contour file an ID and create Map from ID to (i-contour,o-contour).
+           The o-contour is None if there is no o-contour with the same ID.
+        """ 
         
-        return self.dataIndex[self.batchStart:self.batchEnd]
-
+        self.i_contourFileMap = self.createContourIdMap(self.i_contourFileList)
+        self.o_contourFileMap = self.createContourIdMap(self.o_contourFileList)
+        
+        for key in self.o_contourFileMap.keys():
+            if not self.i_contourFileMap.has_key(key):
+                print "Warning: no contour match for ",self.o_contourFileMap[key]
+                
+        for key in self.i_contourFileMap.keys():
+            self.contourFileMap[key]= (self.i_contourFileMap[key],self.o_contourFileMap.get(key))
 
 
-    
-class ImagePipeline(ImageTools,ImagePipelineBase):
-    """ Image Pipeline for dicom image"""
-    def __init__(self,dcmPath,contourPath,linkFile):
-        
-        self.dcmPath  = dcmPath
-        self.contPath = contourPath
-        self.linkFile = linkFile
-        self.linkDict = {}
-        
-        self.allFilePairs = []
-        self._ndata = -1
-        
-        self.imaHeight =256
-        self.imaWidth  =256
+    def getDicomImageAndContourFiles(self,fileId):
+        """ Get a single dicom image and the matching contour files
+        :fileId: string 
+        :return: (dcmFile,i_contourFile,o_contourFile), o_contourFile may be None
+        """
         
-        self.dataIndex = []
-        self.batchStart = None # including
-        self.batchEnd  = None  # excluding 
+        if not self.contourFileMap.has_key(fileId):
+            print "Unknown contour File ID {}".format(fileId)
+            return None,None,None
+            
+        dcmFile   = self.getDicomImageFile(fileId) 
+        if dcmFile == None:
+            return None,None,None
+        else:
+            i_contFile, o_contFile = self.contourFileMap[fileId]
+            i_contFile   = os.path.join(self.i_contourPath,i_contFile)
+            if o_contFile!=None:
+                o_contFile   = os.path.join(self.o_contourPath,o_contFile)
+            
+            return (dcmFile,i_contFile,o_contFile)
+      
+                
+    def getContourFiles(self,fileId):
+        """ i-/o-contour files of a contour file ID, whether or not the dicom file exists
+        :return: (i_contourFile,o_contourFile), o_contourFile may be None
+        """
+        i_contFile, o_contFile = self.contourFileMap[fileId]
+        i_contFile = os.path.join(self.i_contourPath,i_contFile)
+        if o_contFile!=None:
+            o_contFile = os.path.join(self.o_contourPath,o_contFile)
+        return (i_contFile,o_contFile)
+      
+                
+    def getDicomImageAndMask(self,fileId):
+        """ Get a single dicom image and masks from the contour files
+        :fileId: string 
+        :return: (dcmImage,i_mask,o_mask,o_valid), o_mask is empty if o_valid is False
+        """
+                    
+        (dcmFile,i_contFile,o_contFile)   = self.getDicomImageAndContourFiles(fileId)
+        
+        if dcmFile==None or i_contFile==None:
+            return None,None,None,False
+  
+        dcmData = self.parse_dicom_file(dcmFile)
+        i_mask  = self.getContourMask(i_contFile,dcmData['width'], dcmData['height'])
+        if o_contFile!=None:
+            o_mask  = self.getContourMask(o_contFile,dcmData['width'], dcmData['height'])
+        else:
+            o_mask  = np.zeros((dcmData['height'],dcmData['width']),dtype=bool)
+
+        return (dcmData['pixel_data'],i_mask,o_mask,o_contFile!=None)  
+
+
+
+class ContourWriter(ImageTools):
+    """ Extracts contour polygons from stacks of masks and writes them as contour files.
+        Polygons are traced radially from the mask centroid, which is exact for
+        star-shaped regions such as the blood pool and the outer heart wall.
+        Masks that are not star-shaped around their centroid, e.g. rings or several
+        components, are detected by rasterizing the polygon again and are skipped.
+    """
+    def __init__(self,nrays=180,radialStep=0.25,tolerance=0.0,minOverlap=0.8):
+        
+        self.nrays      = nrays      # number of polygon vertices before simplification
+        self.radialStep = radialStep # sampling step along each ray in pixels
+        self.tolerance  = tolerance  # simplification tolerance in pixels, 0 to disable
+        self.minOverlap = minOverlap # minimal IoU of the rasterized polygon and the mask
+        self.chunkSize  = 64         # masks traced at once
+        
+        self.filePrefix = 'IM-0001-' # createContourIdMap reads the ID at [8:12]
+        self._IdDigits  = 4
+        
+        
+    def masksToPolygons(self,masks):
+        """ Trace the outline of every mask in a stack
+        :param masks: Boolean masks of shape (N, H, W)
+        :return: list of N float arrays of shape (K, 2) with x, y coords,
+                 None for empty masks and masks that cannot be traced
+        """
+        masks = np.asarray(masks,dtype=bool)
+        nmasks, height, width = masks.shape
+        
+        angles = np.linspace(0,2*np.pi,self.nrays,endpoint=False)
+        radii  = np.arange(0,np.hypot(height,width),self.radialStep)
+        dx     = np.cos(angles)[:,None]*radii[None,:] # (K, R)
+        dy     = np.sin(angles)[:,None]*radii[None,:]
+        yy, xx = np.mgrid[0:height,0:width]
+        
+        polygons = []
+        for s in range(0,nmasks,self.chunkSize):
+            chunk = masks[s:s+self.chunkSize]
+            count = chunk.sum(axis=(1,2)).astype(float)
+            safe  = np.maximum(count,1)
+            cx    = (chunk*xx).sum(axis=(1,2))/safe
+            cy    = (chunk*yy).sum(axis=(1,2))/safe
+            
+            # sample the masks along all rays of all masks at once
+            x  = np.rint(cx[:,None,None] + dx[None,:,:]).astype(int)
+            y  = np.rint(cy[:,None,None] + dy[None,:,:]).astype(int)
+            ok = (x>=0) & (x<width) & (y>=0) & (y<height)
+            nidx   = np.arange(len(chunk))[:,None,None]
+            inside = ok & chunk[nidx,np.clip(y,0,height-1),np.clip(x,0,width-1)]
+            
+            # the outline lies half a pixel beyond the last sample inside the mask
+            inside[:,:,0] = True
+            first  = np.argmin(inside,axis=2)
+            first  = np.where(inside.all(axis=2),len(radii),first)
+            radius = radii[first-1] + 0.5
+            
+            # poly_to_mask fills the pixels strictly between the truncated outline coords,
+            # shift by half a pixel so that the polygon rasterizes to the traced mask
+            px = cx[:,None] + np.cos(angles)[None,:]*radius + 0.5
+            py = cy[:,None] + np.sin(angles)[None,:]*radius + 0.5
+            
+            for k in range(len(chunk)):
+                if count[k]==0:
+                    polygons.append(None)
+                    continue
+                if not chunk[k,int(np.rint(cy[k])),int(np.rint(cx[k]))]:
+                    print "Warning: centroid outside of mask {}, mask is not traced".format(s+k)
+                    polygons.append(None)
+                    continue
+                poly = np.column_stack((px[k],py[k]))
+                if self.tolerance>0:
+                    poly = self.simplifyPolygon(poly,self.tolerance)
+                
+                traced  = self.poly_to_mask([tuple(p) for p in poly],width,height)
+                overlap = (traced & chunk[k]).sum()/float((traced | chunk[k]).sum())
+                if overlap<self.minOverlap:
+                    print "Warning: mask {} is not star-shaped (overlap {:.2f}), mask is not traced".format(s+k,overlap)
+                    polygons.append(None)
+                    continue
+                polygons.append(poly)
+        
+        return polygons
+    
+    
+    def simplifyPolygon(self,poly,tolerance):
+        """ Remove vertices closer than tolerance to the chord of their neighbors
+        :param poly: float array of shape (K, 2) of a closed polygon
+        :param tolerance: maximal deviation in pixels
+        :return: simplified polygon
+        """
+        while len(poly)>3:
+            prev = np.roll(poly,1,axis=0)
+            chord = np.roll(poly,-1,axis=0) - prev
+            rel   = poly - prev
+            clen  = np.maximum(np.hypot(chord[:,0],chord[:,1]),1e-12)
+            dev   = np.abs(chord[:,0]*rel[:,1] - chord[:,1]*rel[:,0])/clen
+            
+            # drop every other candidate so that no two neighbors are removed at once
+            cand = np.flatnonzero(dev<tolerance)
+            if len(cand)==0:
+                break
+            cand = cand[::2]
+            if len(cand)>0 and cand[-1]==len(poly)-1 and cand[0]==0:
+                cand = cand[:-1]
+            cand = cand[:len(poly)-3]
+            if len(cand)==0:
+                break
+            poly = np.delete(poly,cand,axis=0)
+            
+        return poly
+    
+    
+    def getContourFileName(self,fileId,contourType='i'):
+        """ Contour file name following the naming convention of the contour files """
+        
+        return '{}{}-{}contour-auto.txt'.format(self.filePrefix,str(fileId).zfill(self._IdDigits),contourType)
+    
+    
+    def writeContourFiles(self,polygons,fileIds,contourPath,contourType='i'):
+        """ Write polygons as contour files with one 'x y' line per vertex
+        :param polygons: list of float arrays of shape (K, 2), None entries are skipped
+        :param fileIds: list of dicom file IDs
+        :param contourPath: output directory
+        :param contourType: 'i' or 'o'
+        :return: list of written files
+        """
+        if not os.path.isdir(contourPath):
+            os.makedirs(contourPath)
+        
+        written = []
+        for poly, fileId in zip(polygons,fileIds):
+            if poly is None:
+                print "Warning: no contour for ID ",fileId
+                continue
+            
+            text = ('%.2f %.2f\n'*len(poly)) % tuple(poly.ravel())
+            contFile = os.path.join(contourPath,self.getContourFileName(fileId,contourType))
+            with open(contFile,'w',1<<16) as outfile:
+                outfile.write(text)
+            written.append(contFile)
+        
+        return written
+    
+    
+    def exportMasks(self,masks,fileIds,contourPath,contourType='i'):
+        """ Trace a stack of masks (N, H, W) and write one contour file per mask
+        :return: list of written files
+        """
+        polygons = self.masksToPolygons(masks)
+        return self.writeContourFiles(polygons,fileIds,contourPath,contourType)
+
+
+
+CODECS = {'none' : (lambda data,level: data, lambda data: data),
+          'zlib' : (zlib.compress, zlib.decompress),
+          'bz2'  : (lambda data,level: bz2.compress(data,max(level,1)), bz2.decompress)}
+if lzma!=None:
+    CODECS['lzma'] = (lambda data,level: lzma.compress(data,preset=level), lzma.decompress)
+
+
+class CompressedSampleCache():
+    """ On-disk cache of preprocessed samples in chunked, compressed blocks.
+        Images are stored as int16 with rescale parameters, masks as packed bits and,
+        for pipelines with targets, the truncated distance maps as float16.
+        Chunks needed for a batch are decompressed in a thread pool.
+    """
+    def __init__(self,cachePath,threads=4):
+        
+        self.cachePath = cachePath
+        self.threads   = threads
+        self.pool      = None
+        self.chunks    = {}  # recently decompressed chunks
+        self.maxChunks = 8
+        self.meta      = None
+        self.position  = {}  # dictionary from sample file tuple to cache index
+        
+        if os.path.isfile(os.path.join(cachePath,'cache.json')):
+            self.readMeta()
+        
+    def readMeta(self):
+        """ Read the cache description """
+        
+        with open(os.path.join(self.cachePath,'cache.json'),'r') as infile:
+            self.meta = json.load(infile)
+        self.position = dict((tuple(files),idx) for idx,files in enumerate(self.meta['files']))
+        
+    def chunkFile(self,chunk,level=0):
+        """ File of a chunk at a pyramid level """
+        
+        if level==0:
+            return os.path.join(self.cachePath,'chunk_{:05d}.bin'.format(chunk))
+        return os.path.join(self.cachePath,'chunk_{:05d}_{}.bin'.format(chunk,level))
+        
+    def build(self,pipeline,chunkSize=32,codec='zlib',compressLevel=6,levels=0,jobs=1):
+        """ Write all samples of a pipeline to the cache
+        :param pipeline: image pipeline with allFilePairs, imaHeight and imaWidth
+        :param chunkSize: samples per compressed chunk
+        :param codec: 'none', 'zlib', 'bz2' (or 'lzma' if available)
+        :param compressLevel: compression level
+        :param levels: number of additional pyramid levels, each downsampled by 2.
+                       Images are block averaged, masks and distance maps computed from the scaled
+                       contours, distances are in pixels of the level.
+        :param jobs: number of worker processes decoding and compressing chunks
+        :return: (raw bytes, stored bytes)
+        """
+        if not CODECS.has_key(codec):
+            print "Error: unknown codec ", codec
+            return
+        if pipeline.imaHeight % 2**levels or pipeline.imaWidth % 2**levels:
+            print "Error: image size is not divisible by ", 2**levels
+            return
+        if not os.path.isdir(self.cachePath):
+            os.makedirs(self.cachePath)
+        
+        files     = [list(f) for f in pipeline.allFilePairs]
+        height    = pipeline.imaHeight
+        width     = pipeline.imaWidth
+        ncontours = len(files[0])-1 if len(files)>0 else 0
+        targets   = bool(getattr(pipeline,'targets',False))
+        maxDist   = pipeline.maxDistance if targets else None
+        
+        tasks = []
+        for chunk, start in enumerate(range(0,len(files),chunkSize)):
+            chunkFiles = [self.chunkFile(chunk,level) for level in range(levels+1)]
+            tasks.append((files[start:start+chunkSize],chunkFiles,height,width,codec,compressLevel,
+                          targets,maxDist))
+        
+        if jobs>1 and len(tasks)>1:
+            pool    = multiprocessing.Pool(jobs)
+            results = pool.map(buildChunk,tasks,chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            results = map(buildChunk,tasks)
+        
+        nbytes = [0,0]
+        for error, chunkBytes in results:
+            if error!=None:
+                print "Error:", error
+                return
+            nbytes[0] += chunkBytes[0]
+            nbytes[1] += chunkBytes[1]
+        
+        meta = {'files' : files, 'height' : height, 'width' : width, 'ncontours' : ncontours,
+                'chunkSize' : chunkSize, 'codec' : codec, 'compressLevel' : compressLevel,
+                'levels' : levels, 'targets' : targets, 'maxDistance' : maxDist}
+        with open(os.path.join(self.cachePath,'cache.json'),'w') as outfile:
+            json.dump(meta,outfile)
+        self.chunks = {}
+        self.readMeta()
+        
+        print "Cache: {} samples, {} levels, {:.1f} MB raw, {:.1f} MB stored ({})".format(
+            len(files),levels+1,nbytes[0]/2.0**20,nbytes[1]/2.0**20,codec)
+        return nbytes
+    
+    def getLevels(self):
+        """ Number of additional pyramid levels in the cache """
+        
+        return self.meta.get('levels',0)
+    
+    def readChunk(self,chunk,level=0):
+        """ Read and decompress a chunk
+        :return: (ima,rescale,valid,masks,sdt) arrays of all samples of the chunk,
+                 sdt is None if the cache holds no distance maps
+        """
+        meta = self.meta
+        with open(self.chunkFile(chunk,level),'rb') as infile:
+            block = CODECS[meta['codec']][1](infile.read())
+        
+        n = min(meta['chunkSize'],len(meta['files'])-chunk*meta['chunkSize'])
+        height, width, ncontours = meta['height']>>level, meta['width']>>level, meta['ncontours']
+        
+        offset  = 0
+        ima     = np.frombuffer(block,np.int16,n*height*width,offset).reshape(n,height,width)
+        offset += ima.nbytes
+        rescale = np.frombuffer(block,float,2*n,offset).reshape(n,2)
+        offset += rescale.nbytes
+        valid   = np.frombuffer(block,bool,ncontours*n,offset).reshape(ncontours,n)
+        offset += valid.nbytes
+        packed  = np.frombuffer(block,np.uint8,ncontours*n*((height*width+7)//8),offset)
+        offset += packed.nbytes
+        masks   = np.unpackbits(packed.reshape(ncontours*n,-1),axis=1)[:,:height*width].astype(bool)
+        sdt     = None
+        if meta.get('targets',False):
+            sdt = np.frombuffer(block,np.float16,ncontours*n*height*width,offset).reshape(ncontours,n,height,width)
+        
+        return ima, rescale, valid, masks.reshape(ncontours,n,height,width), sdt
+    
+    def getChunks(self,chunkIds,level=0):
+        """ Decompressed chunks, missing chunks are decompressed in the thread pool """
+        
+        keys    = set((c,level) for c in chunkIds)
+        missing = [key for key in keys if not self.chunks.has_key(key)]
+        if len(missing)>1 and self.threads>1:
+            if self.pool==None:
+                self.pool = ThreadPool(self.threads)
+            decoded = self.pool.map(lambda key: self.readChunk(*key),missing)
+        else:
+            decoded = [self.readChunk(*key) for key in missing]
+        
+        decoded = dict(zip(missing,decoded))
+        chunks  = dict((key[0],self.chunks[key] if self.chunks.has_key(key) else decoded[key]) for key in keys)
+        
+        if len(self.chunks)+len(missing)>self.maxChunks:
+            self.chunks = {}
+        self.chunks.update(decoded)
+        return chunks
+    
+    def loadSamples(self,cacheIdx,imaBatch,maskBatches,validBatch=None,level=0,targetBatches=None,
+                    labelBatch=None):
+        """ Fill batch arrays with cached samples
+        :param cacheIdx: cache indices of the samples
+        :param imaBatch: float image batch, rescaled like parse_dicom_file, None to skip the images
+        :param maskBatches: list of Boolean mask batches, one per contour type
+        :param validBatch: optional Boolean batch, True where the last contour exists
+        :param level: pyramid level, the batches have size (H, W)/2**level
+        :param targetBatches: optional list of float distance map batches, one per contour type,
+                              NaN for missing contours. Requires a cache built with targets.
+        :param labelBatch: optional uint8 label batch, 1 inside the first contour,
+                           2 inside the last contour but outside the first, else 0
+        """
+        cacheIdx  = np.asarray(cacheIdx,dtype=int)
+        chunkSize = self.meta['chunkSize']
+        chunks    = self.getChunks(list(cacheIdx//chunkSize),level)
+        
+        for k, idx in enumerate(cacheIdx):
+            ima, rescale, valid, masks, sdt = chunks[idx//chunkSize]
+            j = idx % chunkSize
+            if imaBatch is not None:
+                imaBatch[k] = ima[j]*rescale[j,0] + rescale[j,1]
+            for c, maskBatch in enumerate(maskBatches):
+                maskBatch[k] = masks[c,j]
+            if targetBatches is not None:
+                for c, targetBatch in enumerate(targetBatches):
+                    targetBatch[k] = sdt[c,j]
+            if labelBatch is not None:
+                labelBatch[k] = 2*masks[-1,j]
+                labelBatch[k][masks[0,j]] = 1
+            if validBatch is not None:
+                validBatch[k] = valid[-1,j]
+        
+    def diskSize(self):
+        """ Total size of the chunk files in bytes """
+        
+        return sum(os.path.getsize(os.path.join(self.cachePath,f))
+                   for f in os.listdir(self.cachePath) if f.startswith('chunk_'))
+    
+    def close(self):
+        """ Stop the decompression threads """
+        
+        if self.pool!=None:
+            self.pool.close()
+            self.pool = None
+
+
+
+class ReadAheadScheduler():
+    """ Tells the OS which files the next batches of a pipeline will read.
+        Uses posix_fadvise(WILLNEED) where available, otherwise reads the files
+        in background threads to fill the page cache.
+    """
+    def __init__(self,pipeline,nbatches=2,threads=2):
+        
+        self.pipeline  = pipeline
+        self.nbatches  = nbatches
+        self.pool      = ThreadPool(threads)
+        self.scheduled = set() # files of the last look-ahead window
+        self.blockSize = 1<<20
+        
+    def getBatchFiles(self,dataIdx):
+        """ Files read for the samples dataIdx, cache chunks if a cache is attached """
+        
+        ip = self.pipeline
+        if ip.sampleCache!=None:
+            chunkSize = ip.sampleCache.meta['chunkSize']
+            chunks = sorted(set(ip.cacheIndex[np.asarray(dataIdx,dtype=int)]//chunkSize))
+            return [ip.sampleCache.chunkFile(c,ip.level) for c in chunks]
+        
+        files = []
+        for k in ip.getReadOrder(dataIdx):
+            files += [f for f in ip.allFilePairs[ dataIdx[k] ] if f!=None]
+        return files
+        
+    def schedule(self):
+        """ Schedule the files of the upcoming batches that were not in the previous window """
+        
+        window = []
+        for dataIdx in self.pipeline.peekBatchDataIndices(self.nbatches):
+            window += self.getBatchFiles(dataIdx)
+        
+        files = []
+        for f in window:
+            if f not in self.scheduled:
+                self.scheduled.add(f)
+                files.append(f)
+        self.scheduled = set(window)
+        if len(files)>0:
+            self.pool.apply_async(readAhead,(files,self.blockSize))
+        
+    def reset(self):
+        """ Forget the previous window, e.g. after the loader state was restored """
+        
+        self.scheduled = set()
+        
+    def close(self):
+        """ Stop the read threads """
+        
+        self.pool.close()
+        self.pool.join()
+
+
+def readAhead(files,blockSize=1<<20):
+    """ Bring files into the page cache, worker of ReadAheadScheduler """
+    
+    fadvise = getattr(os,'posix_fadvise',None)
+    for filename in files:
+        try:
+            if fadvise!=None:
+                fd = os.open(filename,os.O_RDONLY)
+                try:
+                    fadvise(fd,0,0,os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            else:
+                with open(filename,'rb') as infile:
+                    while infile.read(blockSize):
+                        pass
+        except (IOError,OSError):
+            pass
+
+
+class DataTuple(tuple):
+    """ Tuple of data arrays that reports their backing: 'memory' or 'memmap' """
+    def __new__(cls,arrays,backing):
+        data = tuple.__new__(cls,arrays)
+        data.backing = backing
+        return data
+
+
+
+class PatientFolds():
+    """ Patient-level k-fold splits of a pipeline data set.
+        Folds are defined on the link file patient ids, all samples of a patient are in
+        the same fold. A train/validation split is one fold, e.g. fold 0 of 5 folds.
+        Create the folds after the quarantine is applied, they refer to the data indices.
+    """
+    def __init__(self,pipeline,nfolds=5,seed=None):
+        
+        self.pipeline    = pipeline
+        self.nfolds      = nfolds
+        self.patientFold = {} # dictionary from patient id to fold
+        self.sampleFold  = np.zeros(0,dtype=int) # fold of each sample, -1 if unassigned
+        
+        self.assignFolds(nfolds,seed)
+        
+    def assignFolds(self,nfolds,seed=None):
+        """ Assign patients to folds with balanced sample counts.
+            Patients are distributed in random order, largest first, to the fold with fewest samples.
+        """
+        patients = self.pipeline.getSamplePatients()
+        counts   = {}
+        for patient in patients:
+            counts[patient] = counts.get(patient,0) + 1
+        
+        order = list(np.random.RandomState(seed).permutation(sorted(counts.keys())))
+        order.sort(key=lambda patient: -counts[patient]) # stable, ties stay in random order
+        
+        foldSize = np.zeros(nfolds,dtype=int)
+        self.patientFold = {}
+        for patient in order:
+            fold = int(np.argmin(foldSize))
+            self.patientFold[patient] = fold
+            foldSize[fold] += counts[patient]
+        
+        self.nfolds = nfolds
+        self.updateSampleFolds()
+        
+    def updateSampleFolds(self):
+        """ Fold of each sample of the pipeline from the patient folds """
+        
+        patients = self.pipeline.getSamplePatients()
+        self.sampleFold = np.array([self.patientFold.get(patient,-1) for patient in patients],dtype=int)
+        nmissing = (self.sampleFold<0).sum()
+        if nmissing>0:
+            print "Warning: {} samples of patients without fold are not used".format(nmissing)
+        
+    def saveFolds(self,filename):
+        """ Write the patient folds to a JSON file """
+        
+        with open(filename,'w') as outfile:
+            json.dump({'nfolds' : self.nfolds, 'folds' : self.patientFold},outfile,indent=1,sort_keys=True)
+            
+    def loadFolds(self,filename):
+        """ Read patient folds written by saveFolds
+        :return: True if successful
+        """
+        try:
+            with open(filename,'r') as infile:
+                folds = json.load(infile)
+        except (IOError,ValueError) as err:
+            print "Error: ", err.args, filename
+            return False
+        
+        self.nfolds      = folds['nfolds']
+        self.patientFold = dict((str(patient),fold) for patient,fold in folds['folds'].items())
+        self.updateSampleFolds()
+        return True
+        
+    def getFoldIndices(self,fold,subset='train'):
+        """ Data indices of a fold
+        :param subset: 'train' for all other folds, 'validation' for the fold itself
+        """
+        if subset=='validation':
+            return np.flatnonzero(self.sampleFold==fold)
+        return np.flatnonzero((self.sampleFold!=fold) & (self.sampleFold>=0))
+        
+    def getView(self,fold,subset='train',data=None,seed=None,shuffle=None):
+        """ Index view of a fold over the shared data of the pipeline
+        :param data: DataTuple of getAllData, None to read from the attached sample cache
+        :param shuffle: shuffle the batch order, default for the training subset only
+        """
+        if shuffle==None:
+            shuffle = subset=='train'
+        return FoldView(self.pipeline,self.getFoldIndices(fold,subset),data,seed,shuffle)
+        
+    def getFoldSizes(self):
+        """ Number of patients and samples per fold """
+        
+        patients = [sum(1 for f in self.patientFold.values() if f==fold) for fold in range(self.nfolds)]
+        samples  = [int((self.sampleFold==fold).sum()) for fold in range(self.nfolds)]
+        return patients, samples
+        
+
+
+class FoldView():
+    """ Subset of the samples of a pipeline with its own batch order.
+        Samples are gathered from one shared data set, either the arrays of getAllData
+        (in memory or memory-mapped) or the sample cache attached to the pipeline,
+        so a view only holds its data indices.
+    """
+    def __init__(self,pipeline,dataIdx,data=None,seed=None,shuffle=True):
+        
+        self.pipeline  = pipeline
+        self.indices   = np.asarray(dataIdx,dtype=int)
+        self.data      = data
+        self.shuffle   = shuffle
+        self.batchSize = pipeline.batchSize
+        
+        self.dataIndex  = []
+        self.batchStart = None # including
+        self.batchEnd   = None # excluding
+        self.epoch      = 0
+        self.randomState = np.random.RandomState(seed)
+        
+    def __len__(self):
+        
+        return len(self.indices)
+        
+    def resetBatchOrder(self):
+        """ Reset or initialize batch order and reshuffle"""
+        
+        self.batchStart = 0
+        self.batchEnd   = self.batchStart+self.batchSize
+        self.dataIndex  = self.randomState.permutation(self.indices) if self.shuffle else self.indices
+        
+    def getNextBatchIndices(self):
+        """ Data indices of the next batch, a new epoch starts after the last full batch """
+        
+        if self.batchStart==None:
+            self.resetBatchOrder()
+        else:
+            self.batchStart += self.batchSize
+            self.batchEnd   += self.batchSize
+            
+            if self.batchEnd>len(self.dataIndex):
+                self.epoch += 1
+                self.resetBatchOrder()
+        
+        return self.dataIndex[self.batchStart:self.batchEnd]
+        
+    def state_dict(self):
+        """ View state to resume at the exact next batch, the shared data is not included
+        :return: dictionary with indices, shuffle order, epoch position and random states
+        """
+        state = {'indices'     : self.indices.copy(),
+                 'dataIndex'   : np.array(self.dataIndex,dtype=int),
+                 'batchStart'  : self.batchStart,
+                 'batchEnd'    : self.batchEnd,
+                 'batchSize'   : self.batchSize,
+                 'epoch'       : self.epoch,
+                 'shuffle'     : self.shuffle,
+                 'randomState' : self.randomState.get_state()
+                }
+        if self.pipeline.augment:
+            state['augRandomState'] = self.pipeline.augRandom.get_state()
+        return state
+        
+    def load_state_dict(self,state):
+        """ Restore a view state from state_dict """
+        
+        self.indices    = np.asarray(state['indices'],dtype=int)
+        self.dataIndex  = np.asarray(state['dataIndex'],dtype=int)
+        self.batchStart = state['batchStart']
+        self.batchEnd   = state['batchEnd']
+        self.batchSize  = state['batchSize']
+        self.epoch      = state['epoch']
+        self.shuffle    = state['shuffle']
+        self.randomState.set_state(state['randomState'])
+        if self.pipeline.augment and state.has_key('augRandomState'):
+            self.pipeline.augRandom.set_state(state['augRandomState'])
+        
+    def loadSamples(self,dataIdx):
+        """ Gather the samples dataIdx from the shared data
+        :return: list of arrays in the layout of the pipeline getNextBatch, None on error
+        """
+        ip = self.pipeline
+        if self.data!=None:
+            out = []
+            for array in self.data:
+                if isinstance(array,dict):
+                    out.append(dict((key,batch[dataIdx]) for key,batch in array.items()))
+                else:
+                    out.append(np.asarray(array[dataIdx]))
+            return out
+        
+        if ip.sampleCache==None:
+            print "Error: fold views need the data of getAllData or an attached sample cache"
+            return None
+        
+        batchDim = (len(dataIdx), ip.imaHeight, ip.imaWidth)
+        imaBatch = np.zeros(batchDim)
+        masks    = [np.zeros(batchDim,dtype=bool) for _ in range(ip.sampleCache.meta['ncontours'])]
+        valid    = np.zeros(len(dataIdx),dtype=bool) if hasattr(ip,'oValid') else None
+        ip.loadCachedSamples(dataIdx,imaBatch,masks,valid)
+        
+        if ip.normalization!=None:
+            imaBatch = ip.normalizeBatch(imaBatch, dataIdx)
+        out = [imaBatch] + masks
+        if valid is not None:
+            out.append(valid)
+        if ip.targets:
+            out.append(ip.getTargetBatches(dataIdx,len(dataIdx)))
+        return out
+        
+    def getNextBatch(self):
+        """ Get new batch of the view, augmented with the pipeline settings """
+        
+        batch = self.loadSamples(self.getNextBatchIndices())
+        if batch==None:
+            return
+        
+        if self.pipeline.augment:
+            spatial = [k for k in range(1,len(batch)) if isinstance(batch[k],dict) or batch[k].ndim>1]
+            augmented = self.pipeline.augmentBatch(batch[0],*[batch[k] for k in spatial])
+            batch[0] = augmented[0]
+            for k, out in zip(spatial,augmented[1:]):
+                batch[k] = out
+        
+        return tuple(batch)
+        
+    def getAllData(self):
+        """ All samples of the view in data index order, without augmentation """
+        
+        data = self.loadSamples(self.indices)
+        if data==None:
+            return
+        return DataTuple(data,'memory')
+
+
+
+def imageStats(task):
+    """ Intensity statistics of a single image, worker of computeIntensityStats
+    :param task: (dcmFile,contourFile,percentiles), contourFile may be None
+    :return: ((mean,std,percentiles),contour statistics or None), None if unreadable
+    """
+    dcmFile, contFile, percentiles = task
+    tools   = ImageTools()
+    dcmData = tools.parse_dicom_file(dcmFile)
+    if dcmData==None:
+        return None
+
+    pixels    = np.asarray(dcmData['pixel_data'],dtype=float)
+    imageStat = (pixels.mean(), pixels.std(), np.percentile(pixels,percentiles))
+
+    contourStat = None
+    if contFile!=None:
+        mask = tools.getContourMask(contFile,dcmData['width'], dcmData['height'])
+        if mask.any():
+            region = pixels[mask]
+            contourStat = (region.mean(), region.std(), np.percentile(region,percentiles))
+
+    return imageStat, contourStat
+
+
+def validateSample(task):
+    """ Check all files of a single sample, worker of validateData
+    :param task: (files,height,width) with files = (dcmFile,contourFiles...)
+    :return: dictionary from file name to list of problems for all files of the sample
+    """
+    files, height, width = task
+    problems = dict((f,[]) for f in files if f!=None)
+    rows, cols = height, width
+
+    # dicom
+    dcmFile = files[0]
+    try:
+        dcm    = dicom.read_file(dcmFile)
+        rows   = int(dcm.Rows)
+        cols   = int(dcm.Columns)
+        pixels = dcm.pixel_array
+        if pixels.shape!=(rows,cols):
+            problems[dcmFile].append('pixel data shape {} does not match header'.format(pixels.shape))
+        if (rows,cols)!=(height,width):
+            problems[dcmFile].append('image dimensions {}x{}'.format(rows,cols))
+        for tag in ['RescaleSlope','RescaleIntercept']:
+            try:
+                value = float(getattr(dcm,tag,0.0))
+            except (TypeError,ValueError):
+                value = np.nan
+            if not np.isfinite(value):
+                problems[dcmFile].append('invalid '+tag)
+    except Exception as err:
+        problems[dcmFile].append('not decodable: {}'.format(err))
+
+    # contours
+    tools = ImageTools()
+    for contFile in files[1:]:
+        if contFile==None:
+            continue
+        try:
+            coords = np.array(tools.parse_contour_file(contFile))
+        except (IOError,ValueError,IndexError) as err:
+            problems[contFile].append('not parseable: {}'.format(err))
+            continue
+        if len(coords)<3:
+            problems[contFile].append('fewer than 3 points')
+        elif (not np.isfinite(coords).all() or coords[:,0].min()<0 or coords[:,0].max()>cols
+              or coords[:,1].min()<0 or coords[:,1].max()>rows):
+            problems[contFile].append('coordinates outside image bounds')
+
+    return problems
+
+
+
+def buildChunk(task):
+    """ Decode, compress and write one chunk at all pyramid levels, worker of CompressedSampleCache.build
+    :param task: (files,chunkFiles,height,width,codec,compressLevel,targets,maxDistance)
+                 with one chunk file per level
+    :return: (error message or None, (raw bytes, stored bytes))
+    """
+    files, chunkFiles, height, width, codec, compressLevel, targets, maxDistance = task
+    tools     = ImagePipelineBase()
+    compress  = CODECS[codec][0]
+    n         = len(files)
+    ncontours = len(files[0])-1
+    ima       = np.zeros((n,height,width),dtype=np.int16)
+    rescale   = np.zeros((n,2))
+    valid     = np.zeros((ncontours,n),dtype=bool)
+    polygons  = [[None]*n for _ in range(ncontours)]
+    nbytes    = [0,0]
+    
+    for k, sampleFiles in enumerate(files):
+        raw = tools.read_dicom_raw(sampleFiles[0])
+        if raw==None:
+            return "unreadable dicom file {}".format(sampleFiles[0]), nbytes
+        if raw[0].shape!=(height,width):
+            return "image format don't match {}".format(sampleFiles[0]), nbytes
+        if raw[0].min()<-2**15 or raw[0].max()>=2**15:
+            return "pixel values exceed int16 {}".format(sampleFiles[0]), nbytes
+        ima[k]     = raw[0]
+        rescale[k] = raw[1:]
+        for c, contFile in enumerate(sampleFiles[1:]):
+            if contFile!=None:
+                try:
+                    polygons[c][k] = np.array(tools.parse_contour_file(contFile))
+                except (IOError,ValueError,IndexError) as err:
+                    return "contour file not parseable {}: {}".format(contFile,err), nbytes
+                valid[c,k] = True
+    
+    for level, chunkFile in enumerate(chunkFiles):
+        scale = 2**level
+        h, w  = height//scale, width//scale
+        
+        # block average of the stored values, same rescale parameters
+        levelIma = np.rint(ima.reshape(n,h,scale,w,scale).mean(axis=(2,4))).astype(np.int16)
+        
+        # masks rasterized from contour coordinates in the pixel grid of the level
+        masks = np.zeros((ncontours,n,h,w),dtype=bool)
+        sdt   = np.empty((ncontours,n,h,w),dtype=np.float16) if targets else None
+        for c in range(ncontours):
+            for k in range(n):
+                if polygons[c][k] is not None:
+                    coords = map(tuple,(polygons[c][k]+0.5)/scale - 0.5)
+                    masks[c,k] = tools.poly_to_mask(coords,w,h)
+                    if targets:
+                        sdt[c,k] = tools.signedDistance(coords,w,h,maxDistance,masks[c,k])
+                elif targets:
+                    sdt[c,k] = np.nan
+        
+        block = (levelIma.tostring() + rescale.tostring() + valid.tostring() +
+                 np.packbits(masks.reshape(ncontours*n,-1),axis=1).tostring())
+        if targets:
+            block += sdt.tostring()
+        stored = compress(block,compressLevel)
+        with open(chunkFile,'wb') as outfile:
+            outfile.write(stored)
+        nbytes[0] += len(block)
+        nbytes[1] += len(stored)
+    
+    return None, nbytes
+
+
+
+class ImagePipelineBase(ImageTools,ImageAugmentation,ContourTargets,ContourGeometry):
+    """ Image Pipeline Base class with general methods"""
+
+    def read_link_file(self):
+        """ import the link file """
+        
+        try:
+            with open(self.linkFile, "r") as csvfile:
+                reader = csv.reader(csvfile)
+                next(reader, None)  # skip the headers
+                for row in reader:
+                    if len(row)==2: 
+                        self.linkDict[row[0]] = row[1]
+                    else:
+                        print "Warning: unknown format"
+        except IOError as err:
+            print "Error: ", err.args, self.linkFile
+            return
+    
+    
+    def attachCache(self,sampleCache):
+        """ Read images and masks from a CompressedSampleCache instead of the dicom files
+        :return: True if the cache holds all samples of the data set
+        """
+        try:
+            cacheIdx = [sampleCache.position[tuple(files)] for files in self.allFilePairs]
+        except KeyError:
+            print "Error: cache does not contain all samples, rebuild the cache"
+            return False
+        
+        self.sampleCache = sampleCache
+        self.cacheIndex  = np.array(cacheIdx,dtype=int)
+        return True
+
+
+    def loadCachedSamples(self,dataIdx,imaBatch,maskBatches,validBatch=None,level=0,targetBatches=None,
+                          labelBatch=None):
+        """ Fill batch arrays with the samples dataIdx from the attached cache """
+        
+        self.sampleCache.loadSamples(self.cacheIndex[np.asarray(dataIdx,dtype=int)],
+                                     imaBatch,maskBatches,validBatch,level,targetBatches,labelBatch)
+
+
+    def hasCachedTargets(self):
+        """ True if the attached cache holds the distance maps of the target settings """
+        
+        if self.sampleCache==None or not self.sampleCache.meta.get('targets',False):
+            return False
+        return self.sampleCache.meta.get('maxDistance')==self.maxDistance
+
+
+    def getLevelShape(self,level=0):
+        """ Image size (height,width) at a pyramid level of the attached cache
+        :return: None if the level is not available
+        """
+        if level==0:
+            return self.imaHeight, self.imaWidth
+        if self.sampleCache==None or self.sampleCache.getLevels()<level:
+            print "Error: pyramid level {} requires a sample cache with this level".format(level)
+            return None
+        if self.targets and not self.hasCachedTargets():
+            print "Error: targets at pyramid levels require a sample cache built with the same targets"
+            return None
+        return self.imaHeight>>level, self.imaWidth>>level
+
+
+    def getDataAllocator(self,nbytes,max_memory=None):
+        """ Array allocator for data sets of estimated size nbytes.
+            Above max_memory bytes arrays are temporary memory-mapped files (in self.tmpDir),
+            which are removed as soon as the arrays are released.
+        :return: (alloc,backing) with alloc(shape,dtype) returning a zero initialized array
+        """
+        if max_memory==None or nbytes<=max_memory:
+            return (lambda shape,dtype: np.zeros(shape,dtype=dtype)), 'memory'
+
+        print "Data set of {:.1f} MB exceeds memory budget, using memory-mapped files".format(nbytes/2.0**20)
+        tmpDir = getattr(self,'tmpDir',None)
+
+        def alloc(shape,dtype):
+            fd, filename = tempfile.mkstemp(suffix='.dat',dir=tmpDir)
+            os.close(fd)
+            data = np.memmap(filename,dtype=dtype,mode='w+',shape=shape)
+            try:
+                os.remove(filename) # mapping stays valid until the array is released
+            except OSError:
+                pass
+            return data
+
+        return alloc, 'memmap'
+
+
+    def getAllDataSize(self,imaBytes=8,ncontours=2):
+        """ Estimated footprint in bytes of getAllData """
+
+        pixels = max(self._ndata,0)*self.imaHeight*self.imaWidth
+        nbytes = pixels*(imaBytes + ncontours)
+        if self.targets:
+            nbytes += pixels*ncontours*(4+1)
+        return nbytes
+    
+    
+    def getFileSignature(self,filename):
+        """ (modification time,size) of a file, None if it does not exist """
+        try:
+            stat = os.stat(filename)
+            return [stat.st_mtime,stat.st_size]
+        except OSError:
+            return None
+
+
+    def validateData(self,quarantineFile=None,jobs=1):
+        """ Check all files of the data set ahead of time and skip bad samples.
+            Results are cached in quarantineFile (json) together with the file signatures,
+            only new or modified files are checked again.
+        :param quarantineFile: quarantine cache file, None to disable caching
+        :param jobs: number of worker processes
+        :return: dictionary from bad file name to list of problems
+        """
+        cache = {'checked' : {}, 'quarantine' : {}}
+        if quarantineFile!=None and os.path.isfile(quarantineFile):
+            with open(quarantineFile,'r') as infile:
+                cache = json.load(infile)
+        checked    = cache['checked']
+        quarantine = cache['quarantine']
+
+        # samples with new or modified files
+        tasks = []
+        for files in self.allFilePairs:
+            files = [f for f in files if f!=None]
+            if any(checked.get(f)!=self.getFileSignature(f) for f in files):
+                tasks.append((tuple(files),self.imaHeight,self.imaWidth))
+
+        if jobs>1 and len(tasks)>0:
+            pool    = multiprocessing.Pool(jobs)
+            results = pool.map(validateSample,tasks,chunksize=max(1,len(tasks)//(4*jobs)))
+            pool.close()
+            pool.join()
+        else:
+            results = map(validateSample,tasks)
+
+        for problems in results:
+            for filename, fileProblems in problems.items():
+                checked[filename] = self.getFileSignature(filename)
+                if len(fileProblems)>0:
+                    quarantine[filename] = fileProblems
+                elif quarantine.has_key(filename):
+                    del quarantine[filename]
+
+        print "Validated {} samples, {} files in quarantine".format(len(tasks),len(quarantine))
+        if quarantineFile!=None:
+            with open(quarantineFile,'w') as outfile:
+                json.dump(cache,outfile,indent=1,sort_keys=True)
+
+        self.applyQuarantine(quarantine)
+        return quarantine
+
+
+    def loadQuarantine(self,quarantineFile):
+        """ Skip all samples listed in a quarantine file written by validateData
+        :return: dictionary from bad file name to list of problems
+        """
+        try:
+            with open(quarantineFile,'r') as infile:
+                quarantine = json.load(infile)['quarantine']
+        except IOError as err:
+            print "Error: ", err.args, quarantineFile
+            return {}
+
+        self.applyQuarantine(quarantine)
+        return quarantine
+
+
+    def applyQuarantine(self,quarantine):
+        """ Remove all samples with a file in quarantine from the data set """
+
+        keep = [idx for idx in range(max(self._ndata,0))
+                if not any(f in quarantine for f in self.allFilePairs[idx] if f!=None)]
+        if len(keep)==max(self._ndata,0):
+            return
+
+        print "Skipping {} samples in quarantine".format(self._ndata-len(keep))
+        self.selectSamples(keep)
+
+
+    def selectSamples(self,keep):
+        """ Restrict the data set and all per-sample data to the data indices keep """
+
+        self.allFilePairs = [self.allFilePairs[idx] for idx in keep]
+        if self.sampleCache!=None:
+            self.cacheIndex = self.cacheIndex[keep]
+        if self.intensityStats!=None:
+            for key, value in self.intensityStats.items():
+                if key!='percentile_levels':
+                    self.intensityStats[key] = value[keep]
+        self._ndata = len(self.allFilePairs)
+        self.resetTargetStore()
+
+        # start new epoch
+        self.dataIndex  = []
+        self.batchStart = None
+
+
+    def getSamplePatients(self):
+        """ Link file patient id of each sample, the name of its dicom directory """
+        
+        return [os.path.basename(os.path.dirname(files[0])) for files in self.allFilePairs]
+
+
+    def loadMaskSamples(self,dataIdx,maskBatches,checkHeader=True):
+        """ Fill mask batches with the contour masks of the samples dataIdx.
+            Dicom pixel data is never decoded.
+        :param checkHeader: check the image size in the dicom header,
+                            else the pipeline image size is used without reading the dicom files
+        :return: True if all images match the pipeline image format,
+                 False if a header is unreadable or of a different format
+        """
+        for k, idx in enumerate(dataIdx):
+            files = self.allFilePairs[idx]
+            
+            if checkHeader:
+                header = self.parse_dicom_header(files[0])
+                if header==None or header['height']!=self.imaHeight or header['width']!=self.imaWidth:
+                    print "Error: image format don't match"
+                    return False
+            
+            for maskBatch, contFile in zip(maskBatches,files[1:]):
+                if contFile!=None:
+                    maskBatch[k] = self.getContourMask(contFile,self.imaWidth, self.imaHeight)
+        return True
+
+
+    def getNextMaskBatch(self,checkHeader=True):
+        """ Get new batch of the contour masks only, without images, augmentation or targets
+        :param checkHeader: see loadMaskSamples
+        :return: tuple of mask batches, one per contour type
+        """
+        dataIdx  = self.getNextBatchDataIndices()
+        batchDim = (self.batchSize, self.imaHeight, self.imaWidth)
+        maskBatches = [np.zeros(batchDim,dtype=bool) for _ in self.allFilePairs[0][1:]]
+        
+        if not self.loadMaskSamples(dataIdx,maskBatches,checkHeader):
+            return
+        return tuple(maskBatches)
+
+
+    def getAllMasks(self,max_memory=None,checkHeader=True):
+        """ Get the contour masks of all samples only
+        :param max_memory: memory budget in bytes, larger data sets are memory-mapped
+        :param checkHeader: see loadMaskSamples
+        :return: DataTuple of mask arrays, one per contour type, with attribute backing
+        """
+        ncontours = len(self.allFilePairs[0])-1 if self._ndata>0 else 0
+        nbytes = max(self._ndata,0)*self.imaHeight*self.imaWidth*ncontours
+        alloc, backing = self.getDataAllocator(nbytes,max_memory)
+        
+        dataDim = (max(self._ndata,0), self.imaHeight, self.imaWidth)
+        masks   = [alloc(dataDim,bool) for _ in range(ncontours)]
+        
+        if not self.loadMaskSamples(range(max(self._ndata,0)),masks,checkHeader):
+            return
+        return DataTuple(masks,backing)
+
+
+    def getContourGeometry(self):
+        """ Geometry of the contours of all samples, see ContourGeometry.getGeometryTable
+        :return: dictionary of arrays in data index order with columns 'patient' and
+                 'id', the contourFileMap ID of the sample in its patient directory
+        """
+        table = self.getGeometryTable([files[1:] for files in self.allFilePairs])
+        table['patient'] = np.array(self.getSamplePatients())
+        table['id']      = np.array([os.path.basename(files[0])[:-4].zfill(4) for files in self.allFilePairs])
+        return table
+
+
+    def getVolumeIndex(self,dcmDir):
+        """ Volume index of a patient dicom directory, created once """
+        
+        if not hasattr(self,'volumeIndices'):
+            self.volumeIndices = {}
+        if not self.volumeIndices.has_key(dcmDir):
+            self.volumeIndices[dcmDir] = DicomVolumeIndex(dcmDir)
+        return self.volumeIndices[dcmDir]
+
+
+    def loadBatch25D(self,dataIdx,batchSize,k=1,axis='temporal'):
+        """ Images with their 2k+1 spatial or temporal neighbors as channels and
+            the masks of the center images. Each neighbor is decoded once per batch.
+            Neighbors that cannot be read are replaced by the center image.
+        :return: (imaBatch,mask batches...) with imaBatch of shape (batchSize, 2k+1, H, W)
+        """
+        nchannels = 2*k+1
+        imaBatch  = np.zeros((batchSize,nchannels,self.imaHeight,self.imaWidth))
+        ncontours = len(self.allFilePairs[dataIdx[0]])-1 if len(dataIdx)>0 else 0
+        maskBatches = [np.zeros((batchSize,self.imaHeight,self.imaWidth),dtype=bool) for _ in range(ncontours)]
+        decoded = {} # shared decodes within the batch
+        
+        for n in range(len(dataIdx)):
+            files  = self.allFilePairs[ dataIdx[n] ]
+            dcmDir = os.path.dirname(files[0])
+            volume = self.getVolumeIndex(dcmDir)
+            fileId = os.path.basename(files[0])[:-4].zfill(volume._IdDigits)
+            
+            neighborIds = volume.getNeighborIds(fileId,k,axis)
+            if neighborIds==None: # center header unreadable, no neighbors known
+                neighborIds = [fileId]*nchannels
+            
+            frames = []
+            for neighborId in neighborIds:
+                dcmFile = volume.getDicomImageFile(neighborId)
+                if not decoded.has_key(dcmFile):
+                    decoded[dcmFile] = None if dcmFile==None else self.parse_dicom_file(dcmFile)
+                frames.append(decoded[dcmFile])
+            
+            if frames[k]==None:
+                print "Error: image {} cannot be read".format(files[0])
+                return
+            
+            for c, dcmData in enumerate(frames):
+                if dcmData==None:
+                    dcmData = frames[k]
+                if dcmData['height']!=self.imaHeight or dcmData['width']!=self.imaWidth:
+                    print "Error: image format don't match"
+                    return
+                imaBatch[n,c] = dcmData['pixel_data']
+            
+            for c, contFile in enumerate(files[1:]):
+                if contFile!=None:
+                    maskBatches[c][n] = self.getContourMask(contFile,self.imaWidth, self.imaHeight)
+        
+        return (imaBatch,)+tuple(maskBatches)
+
+
+    def getNextBatch25D(self,k=1,axis='temporal'):
+        """ Get new batch of images with 2k+1 neighbor channels and the center masks
+        :param k: number of neighbors on each side
+        :param axis: 'temporal' (cine phases of the slice) or 'spatial' (adjacent slices)
+        :return: (imaBatch,mask batches...) with imaBatch of shape (batchSize, 2k+1, H, W)
+        """
+        dataIdx = self.getNextBatchDataIndices()
+        
+        batch = self.loadBatch25D(dataIdx,self.batchSize,k,axis)
+        if batch==None:
+            return
+        
+        if self.normalization!=None:
+            batch = (self.normalizeBatch(batch[0], dataIdx),)+batch[1:]
+        if self.augment:
+            batch = self.augmentBatch(*batch)
+        return batch
+
+
+    def getNextLabelBatch(self,layout='channels_first',asBuffer=False):
+        """ Get new batch of images and uint8 label maps with
+            background (0), blood pool (1, i-contour) and myocardium (2, o-contour without i-contour)
+        :param layout: 'channels_first' (N, 1, H, W) or 'channels_last' (N, H, W, 1), C-contiguous
+        :param asBuffer: return memoryviews of the batches (buffer protocol, no copy)
+        :return: (imaBatch,labelBatch)
+        """
+        if layout not in ('channels_first','channels_last'):
+            print "Error: unknown layout ", layout
+            return
+        
+        dataIdx = self.getNextBatchDataIndices()
+        
+        # contiguous batches in the requested layout, filled through (N, H, W) views
+        if layout=='channels_first':
+            batchDim = (self.batchSize, 1, self.imaHeight, self.imaWidth)
+        else:
+            batchDim = (self.batchSize, self.imaHeight, self.imaWidth, 1)
+        imaBatch   = np.zeros(batchDim)
+        labelBatch = np.zeros(batchDim,dtype=np.uint8)
+        ima    = imaBatch[:,0]   if layout=='channels_first' else imaBatch[...,0]
+        labels = labelBatch[:,0] if layout=='channels_first' else labelBatch[...,0]
+        
+        if self.sampleCache!=None:
+            self.loadCachedSamples(dataIdx,ima,[],labelBatch=labels)
+        else:
+            for k in self.getReadOrder(dataIdx):
+                files   = self.allFilePairs[ dataIdx[k] ]
+                dcmData = self.parse_dicom_file(files[0])
+                
+                if dcmData['height']!=self.imaHeight or dcmData['width']!=self.imaWidth:
+                    print "Error: image format don't match"
+                    return
+                
+                ima[k]    = dcmData['pixel_data']
+                o_contFile = files[2] if len(files)>2 else None
+                labels[k] = self.getContourLabels(files[1],o_contFile,self.imaWidth,self.imaHeight)
+        
+        if self.normalization!=None:
+            self.normalizeBatch(ima, dataIdx)
+        if self.augment:
+            augIma, augLabels = self.augmentBatch(ima, labels)
+            ima[...]    = augIma
+            labels[...] = augLabels
+        
+        if asBuffer:
+            return memoryview(imaBatch), memoryview(labelBatch)
+        return imaBatch, labelBatch
+
+
+    def setReadAhead(self,nbatches=2,threads=2,reorder=False):
+        """ Announce the files of the next nbatches batches to the OS ahead of time
+        :param nbatches: number of upcoming batches to read ahead
+        :param threads: number of background read threads
+        :param reorder: read the files of a batch in on-disk order (sample order is unchanged)
+        """
+        if self.readAhead!=None:
+            self.readAhead.close()
+        self.readAhead = ReadAheadScheduler(self,nbatches,threads)
+        self.readOrdered = reorder
+
+
+    def getReadOrder(self,dataIdx):
+        """ Order in which the samples dataIdx are read, by inode if reordering is enabled
+        :return: list of positions in dataIdx
+        """
+        order = range(len(dataIdx))
+        if not self.readOrdered:
+            return order
+        
+        def inode(k):
+            try:
+                stat = os.stat(self.allFilePairs[ dataIdx[k] ][0])
+                return (stat.st_dev,stat.st_ino)
+            except OSError:
+                return (0,0)
+        return sorted(order,key=inode)
+
+
+    def resetBatchOrder(self):
+        """ Reset or initialize batch order and reshuffle"""
+        self.batchStart= 0
+        self.batchEnd  = self.batchStart+self.batchSize
+        
+        if len(self.dataIndex)==0:
+            self.dataIndex = range(self._ndata)
+        
+        self.randomState.shuffle(self.dataIndex )
+        
+    
+    def getNextBatchIndices(self):
+        """ Create new set of data indeces for new batch of files"""
+        
+        if self.batchStart == None:
+            self.resetBatchOrder()
+        else:   
+            # increment
+            self.batchStart += self.batchSize
+            self.batchEnd   += self.batchSize
+            
+            if self.batchEnd>len(self.dataIndex):
+                self.epoch += 1
+                self.resetBatchOrder()
+
+        if self.readAhead!=None:
+            self.readAhead.schedule()
+        
+        return self.dataIndex[self.batchStart:self.batchEnd]
+
+
+    def toDataIndices(self,batchIdx):
+        """ Indices into allFilePairs of batch indices, as used by getNextBatch"""
+        
+        return [self.dataIndex[idx] for idx in batchIdx]
+
+
+    def getNextBatchDataIndices(self):
+        """ Indices into allFilePairs of the samples of the next batch"""
+        
+        return self.toDataIndices(self.getNextBatchIndices())
+
+
+    def peekBatchDataIndices(self,nbatches=1):
+        """ Indices into allFilePairs of the upcoming batches without advancing.
+            Only batches of the current epoch are known.
+        :return: list of up to nbatches lists of data indices
+        """
+        if self.batchStart==None:
+            return []
+        
+        batches = []
+        for n in range(1,nbatches+1):
+            start = self.batchStart + n*self.batchSize
+            if start+self.batchSize>len(self.dataIndex):
+                break
+            batches.append(self.toDataIndices(self.dataIndex[start:start+self.batchSize]))
+        return batches
+
+
+    def setSeed(self,seed):
+        """ Use a seeded random state for the batch order instead of the global numpy state"""
+        
+        self.seed        = seed
+        self.randomState = np.random.RandomState(seed)
+
+
+    def state_dict(self):
+        """ Loader state to resume at the exact next batch
+        :return: dictionary with data set index, shuffle order, epoch position and random states
+        """
+        state = {'files'       : list(self.allFilePairs),
+                 'dataIndex'   : list(self.dataIndex),
+                 'batchStart'  : self.batchStart,
+                 'batchEnd'    : self.batchEnd,
+                 'batchSize'   : self.batchSize,
+                 'epoch'       : self.epoch,
+                 'level'       : self.level,
+                 'seed'        : self.seed,
+                 'randomState' : self.randomState.get_state(),
+                 'intensityStats' : self.intensityStats
+                }
+        if self.augment:
+            state['augRandomState'] = self.augRandom.get_state()
+        return state
+
+
+    def load_state_dict(self,state):
+        """ Restore a loader state from state_dict without rescanning the directories.
+            An attached cache is re-warmed with the next batch.
+        """
+        self.allFilePairs = list(state['files'])
+        self._ndata       = len(self.allFilePairs)
+        self.resetTargetStore()
+        self.dataIndex    = list(state['dataIndex'])
+        self.batchStart   = state['batchStart']
+        self.batchEnd     = state['batchEnd']
+        self.batchSize    = state['batchSize']
+        self.epoch        = state['epoch']
+        self.level        = state.get('level',0)
+        if state['seed']!=None:
+            self.setSeed(state['seed'])
+        self.randomState.set_state(state['randomState'])
+        self.intensityStats = state['intensityStats']
+        if self.augment and state.has_key('augRandomState'):
+            self.augRandom.set_state(state['augRandomState'])
+        
+        if self.sampleCache!=None and not self.attachCache(self.sampleCache):
+            self.sampleCache = None
+        self.warmUp()
+
+
+    def saveState(self,filename):
+        """ Write the loader state to a file """
+        
+        with open(filename,'wb') as outfile:
+            pickle.dump(self.state_dict(),outfile,pickle.HIGHEST_PROTOCOL)
+
+
+    def loadState(self,filename):
+        """ Restore the loader state from a file written by saveState """
+        
+        with open(filename,'rb') as infile:
+            self.load_state_dict(pickle.load(infile))
+
+
+    def warmUp(self):
+        """ Load the data of the next batch into the attached cache and
+            schedule the upcoming batches for read-ahead
+        """
+        if self.readAhead!=None:
+            self.readAhead.reset()
+            self.readAhead.schedule()
+        
+        batches = self.peekBatchDataIndices(1)
+        if self.sampleCache!=None and len(batches)>0:
+            chunkSize = self.sampleCache.meta['chunkSize']
+            self.sampleCache.getChunks(list(self.cacheIndex[batches[0]]//chunkSize),self.level)
+
+
+    def computeIntensityStats(self,percentiles=(1,99),contourStats=False,jobs=1):
+        """ Compute per-image intensity statistics once for the whole data set.
+            Statistics are stored in self.intensityStats as arrays aligned with allFilePairs.
+        :param percentiles: intensity percentiles to compute for each image
+        :param contourStats: also compute the statistics inside the outermost contour
+                             (o-contour if available, otherwise i-contour)
+        :param jobs: number of worker processes
+        :return: dictionary with arrays 'mean', 'std', 'percentiles' (and 'contour_*')
+        """
+        ndata  = max(self._ndata,0)
+        npct   = len(percentiles)
+        stats  = {'mean'        : np.zeros(ndata),
+                  'std'         : np.ones(ndata),
+                  'percentiles' : np.zeros((ndata,npct)),
+                  'percentile_levels' : np.array(percentiles,dtype=float)
+                 }
+        if contourStats:
+            stats['contour_mean']        = np.zeros(ndata)
+            stats['contour_std']         = np.ones(ndata)
+            stats['contour_percentiles'] = np.zeros((ndata,npct))
+
+        tasks = []
+        for files in self.allFilePairs:
+            contFile = [f for f in files[1:] if f!=None][-1] if contourStats else None
+            tasks.append((files[0],contFile,percentiles))
+        
+        if jobs>1:
+            pool    = multiprocessing.Pool(jobs)
+            results = pool.map(imageStats,tasks,chunksize=max(1,ndata//(4*jobs)))
+            pool.close()
+            pool.join()
+        else:
+            results = map(imageStats,tasks)
+
+        for idx in range(ndata):
+            if results[idx]==None:
+                print "Warning: no statistics for ", tasks[idx][0]
+                continue
+            
+            imageStat, contourStat = results[idx]
+            stats['mean'][idx], stats['std'][idx], stats['percentiles'][idx] = imageStat
+            if contourStat!=None:
+                (stats['contour_mean'][idx], stats['contour_std'][idx],
+                 stats['contour_percentiles'][idx]) = contourStat
+
+        self.intensityStats = stats
+        return stats
+
+
+    def saveIntensityStats(self,filename):
+        """ Store intensity statistics together with the data set index (npz file) """
+
+        if self.intensityStats==None:
+            print "Error: no intensity statistics computed"
+            return
+        dcmFiles = np.array([files[0] for files in self.allFilePairs])
+        np.savez(filename, dcmFiles=dcmFiles, **self.intensityStats)
+
+
+    def loadIntensityStats(self,filename):
+        """ Load intensity statistics stored with saveIntensityStats.
+            The stored data set index must match the current one.
+        :return: True if the statistics were loaded
+        """
+        try:
+            data = np.load(filename)
+        except IOError as err:
+            print "Error: ", err.args, filename
+            return False
+
+        dcmFiles = [files[0] for files in self.allFilePairs]
+        if list(data['dcmFiles'])!=dcmFiles:
+            print "Warning: intensity statistics don't match the data set ", filename
+            return False
+
+        self.intensityStats = dict((key,data[key]) for key in data.files if key!='dcmFiles')
+        return True
+
+
+    def setNormalization(self,mode='zscore',contour=False):
+        """ Enable per-image intensity normalization of all batches
+        :param mode: 'zscore' (mean/std), 'percentile' (lowest/highest percentile to 0/1) or None
+        :param contour: use the statistics of the contour region
+        """
+        if mode not in (None,'zscore','percentile'):
+            print "Error: unknown normalization ", mode
+            return
+        self.normalization        = mode
+        self.normalizationContour = contour
+
+        if mode!=None and (self.intensityStats==None or
+                           (contour and not self.intensityStats.has_key('contour_mean'))):
+            self.computeIntensityStats(contourStats=contour)
+
+
+    def normalizeBatch(self,imaBatch,dataIdx):
+        """ Normalize a batch of images in one vectorized operation
+        :param imaBatch: image batch of shape (N, H, W) or (N, C, H, W)
+        :param dataIdx: data indices of the first len(dataIdx) images of the batch
+        :return: normalized image batch
+        """
+        prefix = 'contour_' if self.normalizationContour else ''
+        dataIdx = np.asarray(dataIdx,dtype=int)
+        nsamples = len(dataIdx)
+
+        if self.normalization=='zscore':
+            offset = self.intensityStats[prefix+'mean'][dataIdx]
+            scale  = self.intensityStats[prefix+'std'][dataIdx]
+        else:
+            pct    = self.intensityStats[prefix+'percentiles'][dataIdx]
+            offset = pct[:,0]
+            scale  = pct[:,-1] - pct[:,0]
+        scale = np.where(scale>0,scale,1.0)
+        shape = (nsamples,)+(1,)*(imaBatch.ndim-1)
+
+        imaBatch[:nsamples] -= offset.reshape(shape)
+        imaBatch[:nsamples] /= scale.reshape(shape)
+        return imaBatch
+
+
+
+    
+class ImagePipeline(ImageTools,ImagePipelineBase):
+    """ Image Pipeline for dicom image"""
+    def __init__(self,dcmPath,contourPath,linkFile,scan=True):
+        
+        self.dcmPath  = dcmPath
+        self.contPath = contourPath
+        self.linkFile = linkFile
+        self.linkDict = {}
+        
+        self.allFilePairs = []
+        self._ndata = -1
+        
+        self.imaHeight =256
+        self.imaWidth  =256
+        
+        self.dataIndex = []
+        self.batchStart = None # including
+        self.batchEnd  = None  # excluding 
         self.batchSize = 8
         
-        self.read_link_file()
-        self.getAllFiles()        
+        self.augment   = False # see setAugmentation
+        self.targets   = False # see setTargets
+        
+        self.normalization  = None # see setNormalization
+        self.intensityStats = None
+        
+        self.tmpDir = None # directory of memory-mapped data, None for system default
+        
+        self.sampleCache = None # see attachCache
+        self.readAhead   = None # see setReadAhead
+        self.readOrdered = False
+        self.level       = 0 # pyramid level of getNextBatch
+        
+        self.epoch       = 0
+        self.seed        = None      # see setSeed
+        self.randomState = np.random # global numpy random state unless seeded
+        
+        if scan: # no scan if the state is restored with load_state_dict
+            self.read_link_file()
+            self.getAllFiles()        
         
     def getAllFiles(self):
         """ Read all files"""
@@ -464,45 +2625,66 @@ class ImagePipeline(ImageTools,ImagePipelineBase):
         print "Total # files: {}".format(self._ndata)
                 
     
-    def getNextBatch(self):
-        """ Get new batch of images and masks"""
+    def getNextBatch(self,level=0):
+        """ Get new batch of images and masks
+        :param level: pyramid level of the attached sample cache, 0 for full resolution
+        """
+        
+        levelShape = self.getLevelShape(level)
+        if levelShape==None:
+            return
+        self.level = level # read-ahead and warm-up use the level of the batches
         
         # get new data indices for next batch
         batchIdx = self.getNextBatchIndices()
         
         # initialize image and mask tensors for batches
-        batchDim   = (self.batchSize, self.imaHeight, self.imaWidth)
+        batchDim   = (self.batchSize,)+levelShape
 
         imaBatch = np.zeros(batchDim)
         maskBatch = np.zeros(batchDim,dtype=bool)
+        dataIdx   = self.toDataIndices(batchIdx)
         
-        for k in range(len(batchIdx)):
+        if self.sampleCache!=None:
+            self.loadCachedSamples(dataIdx,imaBatch,[maskBatch],level=level)
+        else:
+            for k in self.getReadOrder(dataIdx):
             
-            idx = self.dataIndex[batchIdx[k]]
-            dcmFile, contFile = self.allFilePairs[ idx ]
+                idx = dataIdx[k]
+                dcmFile, contFile = self.allFilePairs[ idx ]
             
-            # dicom
-            dcmData = self.parse_dicom_file(dcmFile)
+                # dicom
+                dcmData = self.parse_dicom_file(dcmFile)
             
-            if dcmData['height']!=self.imaHeight or dcmData['width']!=self.imaWidth:
-                print "Error: image format don't match"
-                return
+                if dcmData['height']!=self.imaHeight or dcmData['width']!=self.imaWidth:
+                    print "Error: image format don't match"
+                    return
             
-            imaBatch[k] = dcmData['pixel_data']
+                imaBatch[k] = dcmData['pixel_data']
             
-            # contour
-            maskBatch[k] = self.getContourMask(contFile,self.imaWidth, self.imaHeight)
+                # contour
+                maskBatch[k] = self.getContourMask(contFile,self.imaWidth, self.imaHeight)
 
-            #polyCoords   = self.parse_contour_file(contFile)
-            #maskBatch[k] = self.poly_to_mask(polyCoords,self.imaWidth, self.imaHeight)
+                #polyCoords   = self.parse_contour_file(contFile)
+                #maskBatch[k] = self.poly_to_mask(polyCoords,self.imaWidth, self.imaHeight)
 
-           
+        targets = self.getTargetBatches(dataIdx,self.batchSize,level=level) if self.targets else None
+        
+        if self.normalization!=None:
+            imaBatch = self.normalizeBatch(imaBatch, dataIdx)
+        if self.augment and targets!=None:
+            imaBatch, maskBatch, targets = self.augmentBatch(imaBatch, maskBatch, targets)
+        elif self.augment:
+            imaBatch, maskBatch = self.augmentBatch(imaBatch, maskBatch)
+        
+        if targets!=None:
+            return imaBatch, maskBatch, targets
         return imaBatch, maskBatch
 
 
 class ImagePipeline2(ImageTools,ImagePipelineBase):
     """ Image Pipeline for dicom image"""
-    def __init__(self,dcmPath,contourPath,linkFile):
+    def __init__(self,dcmPath,contourPath,linkFile,scan=True):
         
         self.dcmPath  = dcmPath
         self.contPath = contourPath
@@ -520,8 +2702,26 @@ class ImagePipeline2(ImageTools,ImagePipelineBase):
         self.batchEnd  = None  # excluding 
         self.batchSize = 8
         
-        self.read_link_file()
-        self.getAllFiles()        
+        self.augment   = False # see setAugmentation
+        self.targets   = False # see setTargets
+        
+        self.normalization  = None # see setNormalization
+        self.intensityStats = None
+        
+        self.tmpDir = None # directory of memory-mapped data, None for system default
+        
+        self.sampleCache = None # see attachCache
+        self.readAhead   = None # see setReadAhead
+        self.readOrdered = False
+        self.level       = 0 # pyramid level of getNextBatch
+        
+        self.epoch       = 0
+        self.seed        = None      # see setSeed
+        self.randomState = np.random # global numpy random state unless seeded
+        
+        if scan: # no scan if the state is restored with load_state_dict
+            self.read_link_file()
+            self.getAllFiles()        
        
         
     def getAllFiles(self):
@@ -546,68 +2746,600 @@ class ImagePipeline2(ImageTools,ImagePipelineBase):
         print "Total # files: {}".format(self._ndata)
                        
     
-    def getNextBatch(self):
-        """ Get new batch of images and masks"""
+    def getNextBatch(self,level=0):
+        """ Get new batch of images and masks
+        :param level: pyramid level of the attached sample cache, 0 for full resolution
+        """
+        
+        levelShape = self.getLevelShape(level)
+        if levelShape==None:
+            return
+        self.level = level # read-ahead and warm-up use the level of the batches
         
         # get new data indeces for next batch
         batchIdx = self.getNextBatchIndices()
         
         # initialize image and mask tensors for batches
-        batchDim   = (self.batchSize, self.imaHeight, self.imaWidth)
+        batchDim   = (self.batchSize,)+levelShape
         imaBatch   = np.zeros(batchDim)
         i_maskBatch = np.zeros(batchDim,dtype=bool)
         o_maskBatch = np.zeros(batchDim,dtype=bool)
+        dataIdx     = self.toDataIndices(batchIdx)
         
-        for k in range(len(batchIdx)):
+        if self.sampleCache!=None:
+            self.loadCachedSamples(dataIdx,imaBatch,[i_maskBatch,o_maskBatch],level=level)
+        else:
+            for k in self.getReadOrder(dataIdx):
             
-            idx = self.dataIndex[batchIdx[k]]
-            dcmFile,i_contFile,o_contFile = self.allFilePairs[ idx ]
+                idx = dataIdx[k]
+                dcmFile,i_contFile,o_contFile = self.allFilePairs[ idx ]
             
-            # dicom
-            dcmData = self.parse_dicom_file(dcmFile)
+                # dicom
+                dcmData = self.parse_dicom_file(dcmFile)
             
-            if dcmData['height']!=self.imaHeight or dcmData['width']!=self.imaWidth:
-                print "Error: image format don't match"
-                return
+                if dcmData['height']!=self.imaHeight or dcmData['width']!=self.imaWidth:
+                    print "Error: image format don't match"
+                    return
             
-            imaBatch[k] = dcmData['pixel_data']
+                imaBatch[k] = dcmData['pixel_data']
             
-            # i-/o-contour
-            i_maskBatch[k] = self.getContourMask(i_contFile,self.imaWidth, self.imaHeight)
-            o_maskBatch[k] = self.getContourMask(o_contFile,self.imaWidth, self.imaHeight)
-           
+                # i-/o-contour
+                i_maskBatch[k] = self.getContourMask(i_contFile,self.imaWidth, self.imaHeight)
+                o_maskBatch[k] = self.getContourMask(o_contFile,self.imaWidth, self.imaHeight)
+
+        targets = self.getTargetBatches(dataIdx,self.batchSize,level=level) if self.targets else None
+        
+        if self.normalization!=None:
+            imaBatch = self.normalizeBatch(imaBatch, dataIdx)
+        if self.augment and targets!=None:
+            imaBatch, i_maskBatch, o_maskBatch, targets = self.augmentBatch(imaBatch, i_maskBatch, o_maskBatch, targets)
+        elif self.augment:
+            imaBatch, i_maskBatch, o_maskBatch = self.augmentBatch(imaBatch, i_maskBatch, o_maskBatch)
+        
+        if targets!=None:
+            return imaBatch, i_maskBatch, o_maskBatch, targets
         return imaBatch, i_maskBatch, o_maskBatch
     
-    def getAllData(self):
-        """ Get all images and masks"""
+    def getAllData(self,max_memory=None,level=0):
+        """ Get all images and masks
+        :param max_memory: memory budget in bytes, larger data sets are memory-mapped
+        :param level: pyramid level of the attached sample cache, 0 for full resolution
+        :return: DataTuple (ima,i_mask,o_mask[,targets]) with attribute backing
+        """
+        
+        levelShape = self.getLevelShape(level)
+        if levelShape==None:
+            return
+        
+        alloc, backing = self.getDataAllocator(self.getAllDataSize()>>(2*level),max_memory)
                 
         # initialize image and mask tensors for batches
-        dataDim   = (self._ndata, self.imaHeight, self.imaWidth)
-        ima    = np.zeros(dataDim)
-        i_mask = np.zeros(dataDim,dtype=bool)
-        o_mask = np.zeros(dataDim,dtype=bool)
+        dataDim   = (self._ndata,)+levelShape
+        ima    = alloc(dataDim,float)
+        i_mask = alloc(dataDim,bool)
+        o_mask = alloc(dataDim,bool)
+        
+        if self.sampleCache!=None:
+            self.loadCachedSamples(range(self._ndata),ima,[i_mask,o_mask],level=level)
+        else:
+            for idx in range(self._ndata):
+            
+                dcmFile, i_contFile, o_contFile = self.allFilePairs[ idx ]
+            
+                # dicom
+                dcmData = self.parse_dicom_file(dcmFile)
+            
+                if dcmData['height']!=self.imaHeight or dcmData['width']!=self.imaWidth:
+                    print "Error: image format don't match"
+                    return
+            
+                ima[idx] = dcmData['pixel_data']
+            
+                # i-/o-contour
+                i_mask[idx] = self.getContourMask(i_contFile,self.imaWidth, self.imaHeight)
+                o_mask[idx] = self.getContourMask(o_contFile,self.imaWidth, self.imaHeight)
+
+        if self.normalization!=None:
+            ima = self.normalizeBatch(ima, range(self._ndata))
+        
+        if self.targets:
+            targets = self.getTargetBatches(range(self._ndata),self._ndata,alloc,cache=False,level=level)
+            return DataTuple((ima, i_mask, o_mask, targets),backing)
+        return DataTuple((ima, i_mask, o_mask),backing)
+
+
+class ImagePipeline3(ImageTools,ImagePipelineBase):
+    """ Image Pipeline for dicom images with all i-contours and optional o-contours.
+        All directories are scanned once, every i-contour sample is returned with an
+        o-mask and a flag whether the o-contour exists.
+    """
+    def __init__(self,dcmPath,contourPath,linkFile,scan=True):
+        
+        self.dcmPath  = dcmPath
+        self.contPath = contourPath
+        self.linkFile = linkFile
+        self.linkDict = {}
+        
+        self.allFilePairs = []
+        self.samplePatient = [] # link file patient id of each sample
+        self.oValid = np.zeros(0,dtype=bool) # o-contour exists for sample 
+        self._ndata = -1
+        
+        self.imaHeight =256
+        self.imaWidth  =256
+        
+        self.dataIndex = []
+        self.batchStart = None # including
+        self.batchEnd  = None  # excluding 
+        self.batchSize = 8
+        
+        self.augment   = False # see setAugmentation
+        self.targets   = False # see setTargets
+        
+        self.normalization  = None # see setNormalization
+        self.intensityStats = None
+        
+        self.tmpDir = None # directory of memory-mapped data, None for system default
+        
+        self.sampleCache = None # see attachCache
+        self.readAhead   = None # see setReadAhead
+        self.readOrdered = False
+        self.level       = 0 # pyramid level of getNextBatch
+        
+        self.sampleIndex   = None # eligible samples, see setSampling
+        self.sampleWeights = None
+        
+        self.epoch       = 0
+        self.seed        = None      # see setSeed
+        self.randomState = np.random # global numpy random state unless seeded
+        
+        if scan: # no scan if the state is restored with load_state_dict
+            self.read_link_file()
+            self.getAllFiles()        
+       
+        
+    def getAllFiles(self):
+        """ Read all files"""
+        
+        for key in sorted(self.linkDict.keys()):
+            
+            dcmDir  = os.path.join(self.dcmPath, key )
+            contDir = os.path.join(self.contPath, self.linkDict[key])
+            
+            if not (os.path.isdir(dcmDir) and os.path.isdir(contDir)):
+                print "Warning: invalid directories ", dcmDir, contDir
+                continue
+            
+            # get all i-contours and the matching o-contours
+            dc = DicomContourReader3(dcmDir,contDir)
+            filePairs = [files for files in dc.getAllFilePairs() if files[0]!=None]
+            self.allFilePairs  += filePairs
+            self.samplePatient += [key]*len(filePairs)
+            self._ndata = len(self.allFilePairs)
+        
+        self.oValid = np.array([files[2]!=None for files in self.allFilePairs],dtype=bool)
+        print "Total # files: {} ({} with o-contour)".format(self._ndata,self.oValid.sum())
+        
+        
+    def setSampling(self,requireOContour=False,patients=None,oContourWeights=None,patientWeights=None):
+        """ Restrict and weight the samples used for batches
+        :param requireOContour: only use samples with an o-contour
+        :param patients: list of link file patient ids to use, None for all
+        :param oContourWeights: (weight without o-contour, weight with o-contour)
+        :param patientWeights: dictionary from patient id to weight
+        """
+        patient  = np.array(self.samplePatient)
+        eligible = np.ones(self._ndata,dtype=bool)
+        if requireOContour:
+            eligible &= self.oValid
+        if patients!=None:
+            eligible &= np.in1d(patient,list(patients))
+        self.sampleIndex = np.flatnonzero(eligible)
+        
+        if oContourWeights==None and patientWeights==None:
+            self.sampleWeights = None
+        else:
+            weights = np.ones(self._ndata)
+            if oContourWeights!=None:
+                weights *= np.where(self.oValid,oContourWeights[1],oContourWeights[0])
+            if patientWeights!=None:
+                weights *= np.array([patientWeights.get(key,1.0) for key in self.samplePatient])
+            weights = weights[self.sampleIndex]
+            self.sampleWeights = weights/weights.sum()
+        
+        # start new epoch with the new sampling
+        self.dataIndex  = []
+        self.batchStart = None
+        
+        print "Sampling from {} files".format(len(self.sampleIndex))
+        
+        
+    def selectSamples(self,keep):
+        """ Restrict the data set and all per-sample data to the data indices keep """
+        
+        ImagePipelineBase.selectSamples(self,keep)
+        self.samplePatient = [self.samplePatient[idx] for idx in keep]
+        self.oValid        = self.oValid[keep]
+        self.sampleIndex   = None
+        self.sampleWeights = None
+        
+        
+    def getSamplePatients(self):
+        """ Link file patient id of each sample """
+        
+        return list(self.samplePatient)
+        
+        
+    def resetBatchOrder(self):
+        """ Reset or initialize batch order.
+            Eligible samples are shuffled, or drawn with replacement if weighted.
+        """
+        self.batchStart= 0
+        self.batchEnd  = self.batchStart+self.batchSize
+        
+        if self.sampleIndex is None:
+            self.sampleIndex = np.arange(self._ndata)
+        
+        if self.sampleWeights is None:
+            self.dataIndex = list(self.randomState.permutation(self.sampleIndex))
+        else:
+            self.dataIndex = list(self.randomState.choice(self.sampleIndex,len(self.sampleIndex),
+                                                          replace=True,p=self.sampleWeights))
         
-        for idx in range(self._ndata):
+        
+    def toDataIndices(self,batchIdx):
+        """ Indices into allFilePairs of batch indices"""
+        
+        return list(batchIdx)
+        
+        
+    def state_dict(self):
+        """ Loader state including the sampling configuration """
+        
+        state = ImagePipelineBase.state_dict(self)
+        state['samplePatient'] = list(self.samplePatient)
+        state['oValid']        = self.oValid.copy()
+        state['sampleIndex']   = None if self.sampleIndex is None else self.sampleIndex.copy()
+        state['sampleWeights'] = None if self.sampleWeights is None else self.sampleWeights.copy()
+        return state
+        
+        
+    def load_state_dict(self,state):
+        """ Restore a loader state including the sampling configuration """
+        
+        self.samplePatient = list(state['samplePatient'])
+        self.oValid        = state['oValid']
+        self.sampleIndex   = state['sampleIndex']
+        self.sampleWeights = state['sampleWeights']
+        ImagePipelineBase.load_state_dict(self,state)
+        
+        
+    def getNextBatch25D(self,k=1,axis='temporal'):
+        """ Get new batch of images with 2k+1 neighbor channels, the center masks
+            and the o-contour flags
+        """
+        batch = ImagePipelineBase.getNextBatch25D(self,k,axis)
+        if batch==None:
+            return
+        o_validBatch = np.zeros(self.batchSize,dtype=bool)
+        dataIdx = self.toDataIndices(self.dataIndex[self.batchStart:self.batchEnd])
+        o_validBatch[:len(dataIdx)] = self.oValid[dataIdx]
+        return batch + (o_validBatch,)
+        
+        
+    def getNextMaskBatch(self,checkHeader=True):
+        """ Get new batch of the i-/o-contour masks and o-contour flags only """
+        
+        batch = ImagePipelineBase.getNextMaskBatch(self,checkHeader)
+        if batch==None:
+            return
+        o_validBatch = np.zeros(self.batchSize,dtype=bool)
+        dataIdx = self.toDataIndices(self.dataIndex[self.batchStart:self.batchEnd])
+        o_validBatch[:len(dataIdx)] = self.oValid[dataIdx]
+        return batch + (o_validBatch,)
+        
+        
+    def getAllMasks(self,max_memory=None,checkHeader=True):
+        """ Get the i-/o-contour masks and o-contour flags of all samples only """
+        
+        data = ImagePipelineBase.getAllMasks(self,max_memory,checkHeader)
+        if data==None:
+            return
+        return DataTuple(tuple(data)+(self.oValid.copy(),),data.backing)
+        
+        
+    def loadSamples(self,dataIdx,imaBatch,i_maskBatch,o_maskBatch,o_validBatch,level=0):
+        """ Load images and masks of the given data indices into the output arrays
+        :return: True if all images match the pipeline image format
+        """
+        
+        if self.sampleCache!=None:
+            self.loadCachedSamples(dataIdx,imaBatch,[i_maskBatch,o_maskBatch],o_validBatch,level)
+            return True
+        
+        for k in self.getReadOrder(dataIdx):
             
-            dcmFile, i_contFile, o_contFile = self.allFilePairs[ idx ]
+            dcmFile,i_contFile,o_contFile = self.allFilePairs[ dataIdx[k] ]
             
             # dicom
             dcmData = self.parse_dicom_file(dcmFile)
             
             if dcmData['height']!=self.imaHeight or dcmData['width']!=self.imaWidth:
                 print "Error: image format don't match"
-                return
+                return False
             
-            ima[idx] = dcmData['pixel_data']
+            imaBatch[k] = dcmData['pixel_data']
             
             # i-/o-contour
-            i_mask[idx] = self.getContourMask(i_contFile,self.imaWidth, self.imaHeight)
-            o_mask[idx] = self.getContourMask(o_contFile,self.imaWidth, self.imaHeight)
-           
-        return ima, i_mask, o_mask
-         
+            i_maskBatch[k] = self.getContourMask(i_contFile,self.imaWidth, self.imaHeight)
+            if o_contFile!=None:
+                o_maskBatch[k] = self.getContourMask(o_contFile,self.imaWidth, self.imaHeight)
+            o_validBatch[k] = o_contFile!=None
             
-                                   
+        return True
+                       
+    
+    def getNextBatch(self,level=0):
+        """ Get new batch of images, masks and o-contour flags
+        :param level: pyramid level of the attached sample cache, 0 for full resolution
+        """
+        
+        levelShape = self.getLevelShape(level)
+        if levelShape==None:
+            return
+        self.level = level # read-ahead and warm-up use the level of the batches
+        
+        # get new data indices for next batch
+        dataIdx = self.getNextBatchIndices()
+        
+        # initialize image and mask tensors for batches
+        batchDim     = (self.batchSize,)+levelShape
+        imaBatch     = np.zeros(batchDim)
+        i_maskBatch  = np.zeros(batchDim,dtype=bool)
+        o_maskBatch  = np.zeros(batchDim,dtype=bool)
+        o_validBatch = np.zeros(self.batchSize,dtype=bool)
+        
+        if not self.loadSamples(dataIdx,imaBatch,i_maskBatch,o_maskBatch,o_validBatch,level):
+            return
+        
+        targets = self.getTargetBatches(dataIdx,self.batchSize,level=level) if self.targets else None
+        
+        if self.normalization!=None:
+            imaBatch = self.normalizeBatch(imaBatch, dataIdx)
+        if self.augment and targets!=None:
+            imaBatch, i_maskBatch, o_maskBatch, targets = self.augmentBatch(imaBatch, i_maskBatch, o_maskBatch, targets)
+        elif self.augment:
+            imaBatch, i_maskBatch, o_maskBatch = self.augmentBatch(imaBatch, i_maskBatch, o_maskBatch)
+        
+        if targets!=None:
+            return imaBatch, i_maskBatch, o_maskBatch, o_validBatch, targets
+        return imaBatch, i_maskBatch, o_maskBatch, o_validBatch
+    
+    
+    def getAllData(self,max_memory=None,level=0):
+        """ Get all images, masks and o-contour flags
+        :param max_memory: memory budget in bytes, larger data sets are memory-mapped
+        :param level: pyramid level of the attached sample cache, 0 for full resolution
+        :return: DataTuple (ima,i_mask,o_mask,o_valid[,targets]) with attribute backing
+        """
+        
+        levelShape = self.getLevelShape(level)
+        if levelShape==None:
+            return
+        
+        alloc, backing = self.getDataAllocator(self.getAllDataSize()>>(2*level),max_memory)
+                
+        dataDim = (self._ndata,)+levelShape
+        ima     = alloc(dataDim,float)
+        i_mask  = alloc(dataDim,bool)
+        o_mask  = alloc(dataDim,bool)
+        o_valid = np.zeros(self._ndata,dtype=bool)
+        
+        if not self.loadSamples(range(self._ndata),ima,i_mask,o_mask,o_valid,level):
+            return
+        
+        if self.normalization!=None:
+            ima = self.normalizeBatch(ima, range(self._ndata))
+        
+        if self.targets:
+            targets = self.getTargetBatches(range(self._ndata),self._ndata,alloc,cache=False,level=level)
+            return DataTuple((ima, i_mask, o_mask, o_valid, targets),backing)
+        return DataTuple((ima, i_mask, o_mask, o_valid),backing)
+
+
+
+PIPELINES = {'1' : ImagePipeline, '2' : ImagePipeline2, '3' : ImagePipeline3}
+
+
+def createPipeline(args):
+    """ Create the pipeline selected on the command line and time the directory scan """
+    
+    start = time.time()
+    ip = PIPELINES[args.pipeline](args.dicoms,args.contours,args.link)
+    print "Scan: {} files in {:.2f} s".format(max(ip._ndata,0),time.time()-start)
+    if args.command!='validate' and os.path.isfile(args.quarantine):
+        ip.loadQuarantine(args.quarantine)
+    if args.command=='benchmark' and args.cache!=None:
+        ip.attachCache(CompressedSampleCache(args.cache,threads=args.threads))
+    return ip
+
+
+def runValidate(args):
+    """ Check all files and update the quarantine list """
+    
+    ip = createPipeline(args)
+    start = time.time()
+    quarantine = ip.validateData(args.quarantine,jobs=args.jobs)
+    for filename in sorted(quarantine.keys()):
+        print filename, '; '.join(quarantine[filename])
+    print "Validation: {:.2f} s ({} jobs), quarantine saved to {}".format(
+        time.time()-start,args.jobs,args.quarantine)
+
+
+def runScan(args):
+    """ Scan the cohort and list the samples per patient """
+    
+    ip = createPipeline(args)
+    counts = {}
+    for files in ip.allFilePairs:
+        patient = os.path.basename(os.path.dirname(files[0]))
+        counts[patient] = counts.get(patient,0) + 1
+    for patient in sorted(counts.keys()):
+        print "{:<16} {:>6}".format(patient,counts[patient])
+
+
+def runBuildCache(args):
+    """ Prebuild the intensity statistics index and the sample cache """
+    
+    ip = createPipeline(args)
+    start = time.time()
+    ip.computeIntensityStats(contourStats=True,jobs=args.jobs)
+    ip.saveIntensityStats(args.stats)
+    print "Intensity statistics: {} files in {:.2f} s ({} jobs), saved to {}".format(
+        ip._ndata,time.time()-start,args.jobs,args.stats)
+    
+    if args.cache!=None:
+        start = time.time()
+        if args.targets:
+            ip.setTargets(maxDistance=args.max_distance)
+        nbytes = CompressedSampleCache(args.cache).build(ip,args.chunk_size,args.codec,args.compress_level,
+                                                         args.levels,args.jobs)
+        if nbytes==None:
+            return
+        print "Sample cache: {:.2f} s ({} jobs), saved to {}".format(time.time()-start,args.jobs,args.cache)
+
+
+def runFolds(args):
+    """ Assign the patients to folds and save the fold file """
+    
+    ip = createPipeline(args)
+    folds = PatientFolds(ip,args.nfolds,args.seed)
+    folds.saveFolds(args.output)
+    patients, samples = folds.getFoldSizes()
+    for fold in range(folds.nfolds):
+        print "Fold {}: {:>4} patients {:>6} samples".format(fold,patients[fold],samples[fold])
+    print "Folds saved to {}".format(args.output)
+
+
+def runStats(args):
+    """ Print data set statistics """
+    
+    ip = createPipeline(args)
+    start = time.time()
+    if not (os.path.isfile(args.stats) and ip.loadIntensityStats(args.stats)):
+        ip.computeIntensityStats(contourStats=True,jobs=args.jobs)
+    stats = ip.intensityStats
+    
+    print "Patients: {}".format(len(ip.linkDict))
+    print "Samples:  {}".format(ip._ndata)
+    if isinstance(ip,ImagePipeline3):
+        print "With o-contour: {}".format(ip.oValid.sum())
+    for key in ['mean','std','contour_mean','contour_std']:
+        if stats.has_key(key) and len(stats[key])>0:
+            print "{:<14} min {:10.2f}  median {:10.2f}  max {:10.2f}".format(
+                key,stats[key].min(),np.median(stats[key]),stats[key].max())
+    print "Statistics: {:.2f} s".format(time.time()-start)
+
+
+def runBenchmark(args):
+    """ Measure the throughput of getNextBatch, for each codec of --codecs with a temporary cache """
+    
+    ip = createPipeline(args)
+    ip.batchSize = args.batch_size
+    if args.augment:
+        ip.setAugmentation(seed=0)
+    
+    if args.codecs==None:
+        timeBatches(ip,args)
+        return
+    
+    for codec in args.codecs.split(','):
+        cachePath = tempfile.mkdtemp(prefix='cache_'+codec+'_')
+        try:
+            cache = CompressedSampleCache(cachePath,threads=args.threads)
+            if cache.build(ip,codec=codec,levels=args.level,jobs=args.jobs)==None:
+                continue
+            ip.attachCache(cache)
+            timeBatches(ip,args,cold=True)
+        finally:
+            shutil.rmtree(cachePath)
+    ip.sampleCache = None
+
+
+def timeBatches(ip,args,cold=False):
+    """ Time args.batches calls of getNextBatch and print the throughput
+    :param cold: drop the decompressed chunks of the sample cache before each batch,
+                 so every batch reads and decompresses its chunks
+    """
+    
+    times = []
+    for _ in range(args.batches):
+        if cold and ip.sampleCache!=None:
+            ip.sampleCache.chunks = {}
+        start = time.time()
+        ip.getNextBatch(args.level)
+        times.append(time.time()-start)
+    
+    times = np.array(times)
+    print "Batches: {}, batch size {}".format(args.batches,args.batch_size)
+    print "Time per batch: mean {:.4f} s, median {:.4f} s, max {:.4f} s".format(
+        times.mean(),np.median(times),times.max())
+    print "Throughput: {:.1f} images/s".format(args.batches*args.batch_size/times.sum())
+    if ip.sampleCache!=None:
+        print "Cache: {} codec, {:.1f} MB on disk, {} threads{}".format(
+            ip.sampleCache.meta['codec'],ip.sampleCache.diskSize()/2.0**20,args.threads,
+            ', cold chunk reads' if cold else '')
+        ip.sampleCache.close()
+
+
+def main(argv=None):
+    """ Command line entry point for batch jobs on the pipelines """
+    
+    parser = argparse.ArgumentParser(description='Dicom image pipeline tools')
+    parser.add_argument('--dicoms',   default='final_data/dicoms/',       help='dicom directory')
+    parser.add_argument('--contours', default='final_data/contourfiles/', help='contour directory')
+    parser.add_argument('--link',     default='final_data/link.csv',      help='link file')
+    parser.add_argument('--pipeline', default='2', choices=sorted(PIPELINES.keys()),
+                        help='1: i-contours, 2: i-/o-contours, 3: i-contours with optional o-contours')
+    parser.add_argument('--stats',    default='intensity_stats.npz',      help='intensity statistics file')
+    parser.add_argument('--quarantine', default='quarantine.json',      help='quarantine list of bad files')
+    parser.add_argument('--jobs',     default=1, type=int,                help='number of worker processes')
+    
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('scan',help='scan the cohort from the link file').set_defaults(run=runScan)
+    build = commands.add_parser('build-cache',help='prebuild the intensity statistics index and sample cache')
+    build.add_argument('--cache',      default=None,   help='sample cache directory')
+    build.add_argument('--codec',      default='zlib', choices=sorted(CODECS.keys()), help='compression codec')
+    build.add_argument('--compress-level', default=6, type=int, help='compression level')
+    build.add_argument('--levels',     default=0, type=int, help='additional pyramid levels')
+    build.add_argument('--chunk-size', default=32, type=int, help='samples per chunk')
+    build.add_argument('--targets',    action='store_true', help='store the distance maps of the contours')
+    build.add_argument('--max-distance', default=16.0, type=float, help='truncation distance of the distance maps')
+    build.set_defaults(run=runBuildCache)
+    folds = commands.add_parser('folds',help='assign patients to cross-validation folds')
+    folds.add_argument('--nfolds',     default=5, type=int, help='number of folds')
+    folds.add_argument('--seed',       default=None, type=int, help='random seed of the assignment')
+    folds.add_argument('--output',     default='folds.json', help='fold file')
+    folds.set_defaults(run=runFolds)
+    commands.add_parser('stats',help='print data set statistics').set_defaults(run=runStats)
+    commands.add_parser('validate',help='check all files and update the quarantine list').set_defaults(run=runValidate)
+    bench = commands.add_parser('benchmark',help='measure getNextBatch throughput')
+    bench.add_argument('--batches',    default=20, type=int, help='number of batches')
+    bench.add_argument('--batch-size', default=8,  type=int, help='batch size')
+    bench.add_argument('--augment',    action='store_true',  help='enable augmentation')
+    bench.add_argument('--cache',      default=None,         help='read samples from this sample cache')
+    bench.add_argument('--threads',    default=4,  type=int, help='decompression threads')
+    bench.add_argument('--level',      default=0,  type=int, help='pyramid level of the sample cache')
+    bench.add_argument('--codecs',     default=None,
+                       help='comma separated codecs to compare with temporary caches, e.g. none,zlib,bz2')
+    bench.set_defaults(run=runBenchmark)
+    
+    args  = parser.parse_args(argv)
+    start = time.time()
+    args.run(args)
+    print "Total: {:.2f} s".format(time.time()-start)
+
+
 
 if __name__ == "__main__":
     main()